@@ -0,0 +1,219 @@
+'''
+Compressed, content addressed store of the pauta pages.
+
+    <root>/blobs.pack   the compressed pages, appended one after the other
+    <root>/index.json   sidecar index: page path -> sha256 of the page, and
+                        sha256 -> (offset, size, codec) in blobs.pack
+    <root>/dict.bin     preset dictionary, the start of the first page stored
+
+Pages are keyed by the path scrap.py would write them to, relative to the
+pautas root ("2017-2018/Análise Matemática I (01000010).html"), so
+extract.course_info_from_path works on the keys, and find(year, course_id)
+looks them up. A page with the same content as one already stored (e.g. the
+same pauta scraped again) only adds an index entry.
+
+Pages are compressed with zstd when the zstandard package is installed and
+with zlib otherwise, both primed with the dictionary since most of a page is
+the same page chrome. Reads slice a memory map of blobs.pack.
+
+    python archive.py pack ./pautas/ ./archive/
+    python archive.py unpack ./archive/ ./pautas/
+    python archive.py stats ./archive/
+'''
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+pack_file_name = "blobs.pack"
+index_file_name = "index.json"
+dict_file_name = "dict.bin"
+# zlib only uses the last 32 KB of a preset dictionary
+dict_size = 32768
+
+
+def course_key(path: str) -> Tuple[str, str]:
+    '''(year, course id) of a page path.'''
+    year, file = path.split("/")[-2:]
+    match = re.search(r"\((\d+)\)\.html$", file)
+    return year, match.group(1) if match else file
+
+
+class Archive():
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.pages: Dict[str, str] = {}
+        self.blobs: Dict[str, Tuple[int, int, str]] = {}
+        # (year, course id) -> page path
+        self.courses: Dict[Tuple[str, str], str] = {}
+        self.dictionary: Optional[bytes] = None
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.load()
+        self.pack = open(os.path.join(root, pack_file_name), "ab")
+        self.map: Optional[mmap.mmap] = None
+
+    def load(self):
+        try:
+            with open(os.path.join(self.root, index_file_name)) as f:
+                index = json.load(f)
+            self.pages = index["pages"]
+            self.blobs = {digest: tuple(blob) for digest, blob in index["blobs"].items()}
+            for path in self.pages:
+                self.courses[course_key(path)] = path
+        except FileNotFoundError:
+            pass
+        try:
+            with open(os.path.join(self.root, dict_file_name), "rb") as f:
+                self.dictionary = f.read()
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        with self.lock:
+            self.pack.flush()
+            if not self.dirty:
+                return
+            with open(os.path.join(self.root, index_file_name), "w") as f:
+                json.dump({"pages": self.pages, "blobs": self.blobs}, f,
+                          ensure_ascii=False, sort_keys=True)
+            self.dirty = False
+
+    def close(self):
+        self.save()
+        self.pack.close()
+        if self.map is not None:
+            self.map.close()
+
+    def __enter__(self) -> "Archive":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def compress(self, data: bytes) -> Tuple[bytes, str]:
+        if zstandard is not None:
+            zdict = zstandard.ZstdCompressionDict(
+                self.dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            return zstandard.ZstdCompressor(level=19, dict_data=zdict).compress(data), "zstd"
+        compressor = zlib.compressobj(9, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush(), "zlib"
+
+    def decompress(self, data: bytes, codec: str) -> bytes:
+        if codec == "zstd":
+            if zstandard is None:
+                raise Exception("This archive needs the zstandard package")
+            zdict = zstandard.ZstdCompressionDict(
+                self.dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            return zstandard.ZstdDecompressor(dict_data=zdict).decompress(data)
+        decompressor = zlib.decompressobj(zdict=self.dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def put(self, path: str, html: bytes) -> bool:
+        '''
+        Stores the page at path. Returns False if the same content was already
+        stored (only the index entry is added).
+        '''
+        digest = hashlib.sha256(html).hexdigest()
+        with self.lock:
+            self.pages[path] = digest
+            self.courses[course_key(path)] = path
+            self.dirty = True
+            if digest in self.blobs:
+                return False
+            if self.dictionary is None:
+                self.dictionary = html[:dict_size]
+                with open(os.path.join(self.root, dict_file_name), "wb") as f:
+                    f.write(self.dictionary)
+            data, codec = self.compress(html)
+            offset = self.pack.tell()
+            self.pack.write(data)
+            self.blobs[digest] = (offset, len(data), codec)
+            return True
+
+    def get(self, path: str) -> bytes:
+        '''The page stored at path. Raises KeyError if there is none.'''
+        offset, size, codec = self.blobs[self.pages[path]]
+        with self.lock:
+            if self.map is None or offset + size > len(self.map):
+                self.remap()
+            data = self.map[offset:offset + size]
+        return self.decompress(data, codec)
+
+    def remap(self):
+        self.pack.flush()
+        if self.map is not None:
+            self.map.close()
+        with open(os.path.join(self.root, pack_file_name), "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def paths(self) -> List[str]:
+        return sorted(self.pages)
+
+    def find(self, year: str, course_id: str) -> Optional[str]:
+        '''
+        Path of the pauta of course_id in year (2017-2018 or 2017/2018).
+        '''
+        return self.courses.get((year.replace("/", "-"), course_id))
+
+    def stats(self) -> Dict:
+        stored = sum(size for _, size, _ in self.blobs.values())
+        return {"pages": len(self.pages), "blobs": len(self.blobs), "stored_bytes": stored}
+
+
+def pack(pautas: str, root: str) -> Archive:
+    '''Stores every pauta of a scrap.py pautas tree in the archive at root.'''
+    archive = Archive(root)
+    for year in sorted(os.listdir(pautas)):
+        if not os.path.isdir(os.path.join(pautas, year)):
+            continue
+        for file in sorted(os.listdir(os.path.join(pautas, year))):
+            if re.search(r"\(\d+\)\.html$", file):
+                with open(os.path.join(pautas, year, file), "rb") as f:
+                    archive.put(f"{year}/{file}", f.read())
+    archive.save()
+    return archive
+
+
+def unpack(root: str, pautas: str):
+    with Archive(root) as archive:
+        for path in archive.paths():
+            os.makedirs(os.path.join(pautas, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(pautas, path), "wb") as f:
+                f.write(archive.get(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="store a pautas tree in an archive")
+    pack_parser.add_argument("pautas")
+    pack_parser.add_argument("archive")
+    unpack_parser = subparsers.add_parser("unpack", help="write the pages back to a pautas tree")
+    unpack_parser.add_argument("archive")
+    unpack_parser.add_argument("pautas")
+    stats_parser = subparsers.add_parser("stats")
+    stats_parser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack(args.pautas, args.archive).close()
+    elif args.command == "unpack":
+        unpack(args.archive, args.pautas)
+    if args.command in ("pack", "stats"):
+        with Archive(args.archive) as archive:
+            stats = archive.stats()
+        print(f"{stats['pages']} pages, {stats['blobs']} distinct, "
+              f"{stats['stored_bytes']} bytes stored")
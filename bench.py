@@ -0,0 +1,214 @@
+'''
+Benchmarks of the hot paths, against mock_server.py replaying the recorded
+pages (test.html as the subject form, the pautas/ tree as the pautas):
+
+    login, extract_subjects, gen_subject_configs, one do_register cycle,
+    scrap.saca_disciplinas (per year page), extract.extract (per pauta)
+    and stats.get_top_students
+
+The timings are written to a JSON baseline. Given a previous baseline with
+--compare, the paths whose median got slower than --tolerance are listed
+and the exit status is 1, so it can run as a regression check.
+'''
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup
+
+import bot
+import extract
+import mock_server
+import scrap
+import stats
+from page_cache import ParseCache
+
+baseline_file_name = "bench_baseline.json"
+
+
+def timeit(f: Callable, repeat: int, setup: Callable = None) -> Dict:
+    '''
+    Runs f repeat times after an untimed warm up run, with setup (untimed)
+    before each run. stdout is discarded, some of these paths print a line
+    per row.
+    '''
+    times = []
+    for _ in range(repeat + 1):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            f()
+            times.append((time.perf_counter() - start) * 1000)
+    times = times[1:]
+    return {"runs": repeat,
+            "min_ms": min(times),
+            "median_ms": statistics.median(times),
+            "mean_ms": statistics.mean(times),
+            "max_ms": max(times)}
+
+
+def per_item(f: Callable[[str], None], items: List[str], repeat: int) -> Dict:
+    '''Like timeit, with every run over all items. Times are per item.'''
+    result = timeit(lambda: [f(item) for item in items], repeat)
+    for key in ("min_ms", "median_ms", "mean_ms", "max_ms"):
+        result[key] /= len(items)
+    result["items"] = len(items)
+    return result
+
+
+def bench_bot(mock: mock_server.MockInforestudante, repeat: int) -> Dict[str, Dict]:
+    results = {}
+    results["login"] = timeit(lambda: bot.login(plain_session()), repeat)
+
+    session = plain_session()
+    bot.login(session)
+    _, res = bot.navigate_subjects_page(session)
+
+    def uncached():
+        bot.page_cache = ParseCache(None)
+    results["extract_subjects"] = timeit(lambda: bot.extract_subjects(res), repeat, uncached)
+    subjects = bot.extract_subjects(res)
+    results["extract_subjects_cached"] = timeit(lambda: bot.extract_subjects(res), repeat)
+
+    results["gen_subject_configs"] = timeit(
+        lambda: bot.gen_subject_configs(subjects, session, force=True), repeat, uncached)
+    results["gen_subject_configs_unchanged"] = timeit(
+        lambda: bot.gen_subject_configs(subjects, session), repeat)
+
+    # want the first turma with seats in every zone
+    with open(bot.turmas_file_name) as f:
+        turmas = json.load(f)
+    for zones in turmas.values():
+        for zone in zones.values():
+            if isinstance(zone, dict):
+                zone["want"] = next(o for o in zone["options"] if mock.seats.get(o, 0) > 0)
+    with open(bot.turmas_file_name, "w") as f:
+        json.dump(turmas, f)
+
+    seats = dict(mock.seats)
+
+    def reset_seats():
+        mock.seats.update(seats)
+        mock.registered.clear()
+    results["do_register"] = timeit(
+        lambda: bot.do_register(subjects, session, 0), repeat, reset_seats)
+    return results
+
+
+def plain_session():
+    session = bot.requests.Session()
+    bot.configure_session(session)
+    return session
+
+
+def bench_scrap(mock: mock_server.MockInforestudante, repeat: int) -> Dict:
+    session = plain_session()
+    bot.login(session)
+    scrap.set_base_url(mock.url)
+    scrap.session = scrap.client.new_session()
+    scrap.session.headers["Cookie"] = session.headers["Cookie"]
+    pages = []
+    for year in mock.pautas:
+        r = session.post(scrap.infor_pautas_base + "pesquisaPautas.do",
+                         data={"anoLectivoMinhasUCSeleccionado": year})
+        pages.append(BeautifulSoup(r.content, "html.parser"))
+
+    with tempfile.TemporaryDirectory() as path:
+        def reset():
+            scrap.manifest = {}
+            scrap.changed_files = []
+
+        def saca(page: BeautifulSoup):
+            reset()
+            scrap.saca_disciplinas(page, path)
+        return per_item(saca, pages, repeat)
+
+
+def bench_extract(repeat: int) -> Dict:
+    return per_item(extract.extract, extract.list_pautas(), repeat)
+
+
+def bench_stats(repeat: int) -> Dict:
+    def top():
+        stats.build_indexes()
+        stats.get_top_students()
+    return timeit(top, repeat)
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    slower = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        ratio = result["median_ms"] / old["median_ms"]
+        if ratio > 1 + tolerance:
+            slower.append(f"{name}: {old['median_ms']:.2f} -> {result['median_ms']:.2f} ms "
+                          f"({ratio:.2f}x)")
+    return slower
+
+
+def run(repeat: int) -> Dict:
+    mock = mock_server.MockInforestudante(pautas=extract.pautas_root).start()
+    cwd = os.getcwd()
+    try:
+        bot.set_base_url(mock.url)
+        bot.config = configparser.ConfigParser()
+        bot.config.read_dict({"DEFAULT": {"username": "bench", "password": "bench"}})
+        bot.page_cache = ParseCache(None)
+        results = {}
+        results["extract"] = bench_extract(repeat)
+        results["get_top_students"] = bench_stats(repeat)
+        # the bot writes turmas.json and success.log to the working directory
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                results.update(bench_bot(mock, repeat))
+                results["saca_disciplinas"] = bench_scrap(mock, repeat)
+            finally:
+                os.chdir(cwd)
+    finally:
+        mock.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", default=baseline_file_name,
+                        help="JSON file to write the results to")
+    parser.add_argument("--compare", help="previous results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed median slowdown before it counts as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.repeat)
+    for name, r in results.items():
+        per = " per item" if "items" in r else ""
+        print(f"{name:>24}: median {r['median_ms']:9.2f} ms{per}, "
+              f"min {r['min_ms']:9.2f} ms, max {r['max_ms']:9.2f} ms")
+
+    with open(args.output, "w") as f:
+        json.dump({"time": time.time(), "python": platform.python_version(),
+                   "machine": platform.machine(), "repeat": args.repeat,
+                   "results": results}, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"slower: {line}")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,49 @@
+'''
+Compares the streaming pauta parser with the BeautifulSoup one on the
+checked-in pautas. Checks both give the same rows and prints rows per second.
+'''
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import extract
+
+
+def bench(parse: Callable, pages: List[str], repeat: int) -> Dict:
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            rows += sum(len(r) for r in parse(html).values())
+    elapsed = time.perf_counter() - start
+    return {"rows": rows, "seconds": elapsed, "rows_per_second": rows / elapsed}
+
+
+def load_pages(root: str = None) -> List[str]:
+    pages = []
+    for path in extract.list_pautas(root):
+        with open(path) as f:
+            pages.append(f.read())
+    return pages
+
+
+def check_identical(pages: List[str]) -> bool:
+    return all(extract.extract_rows(html) == extract.extract_rows_soup(html)
+               for html in pages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", default=extract.pautas_root)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    pages = load_pages(args.root)
+    print(f"{len(pages)} pautas, identical output: {check_identical(pages)}")
+
+    soup = bench(extract.extract_rows_soup, pages, args.repeat)
+    fast = bench(extract.extract_rows, pages, args.repeat)
+    for name, r in (("BeautifulSoup", soup), ("PautaParser", fast)):
+        print(f"{name:>14}: {r['rows']} rows in {r['seconds']:.2f} s "
+              f"({r['rows_per_second']:.0f} rows/s)")
+    print(f"Speedup: {soup['seconds'] / fast['seconds']:.1f}x")
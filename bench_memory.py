@@ -0,0 +1,72 @@
+'''
+Memory taken by the extracted grades on the bundled data: the set of
+tuples extract.py used to collect against grade_store.GradeStore, and the
+TinyDB grade documents stats.py loads against a GradeStore of the same
+grades. Sizes are the memory still allocated once each is built
+(tracemalloc), the strings the rows share with the parser included.
+'''
+import contextlib
+import gc
+import io
+import json
+import tracemalloc
+from typing import Callable, Tuple
+
+import extract
+from grade_store import GradeStore
+
+
+def retained(build: Callable) -> Tuple[object, int]:
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def extract_into(grades):
+    '''Extracts the bundled pautas, keeping only the grades.'''
+    extract.new_grades = grades
+    with contextlib.redirect_stdout(io.StringIO()):
+        extract.start_extraction(1)
+    extract.new_students = set()
+    extract.new_courses = set()
+    return extract.new_grades
+
+
+def tinydb_rows(documents):
+    '''The TinyDB grade documents as extract.py rows.'''
+    for doc in documents:
+        for year, phases in doc["scores"].items():
+            for phase, result in phases.items():
+                if result == "-":
+                    continue
+                grade, note = (int(result), None) if result.isnumeric() else (0, result)
+                yield (grade, note, phase, doc["course_id"], doc["num"], year)
+
+
+def load_tinydb():
+    with open("db.json") as f:
+        return list(json.load(f)["grades"].values())
+
+
+if __name__ == "__main__":
+    # import what np.unique loads lazily, so it is not counted as the store
+    len(GradeStore([(10, None, "EF", "1", "1", "2020-2021")]))
+    old, old_size = retained(lambda: extract_into(set()))
+    new, new_size = retained(lambda: extract_into(GradeStore()))
+    print(f"extracted rows: {len(old)} set / {len(new)} store, same rows: {set(new) == old}")
+    print(f"set of tuples: {old_size / 1024:8.0f} KiB")
+    print(f"GradeStore:    {new_size / 1024:8.0f} KiB ({old_size / new_size:.1f}x smaller, "
+          f"columns {new.nbytes() / 1024:.0f} KiB)")
+    del old, new
+
+    documents, docs_size = retained(load_tinydb)
+    rows = list(tinydb_rows(documents))
+    store, store_size = retained(lambda: GradeStore(rows))
+    print(f"TinyDB grade documents: {docs_size / 1024:8.0f} KiB ({len(documents)} documents)")
+    print(f"GradeStore of them:     {store_size / 1024:8.0f} KiB ({len(store)} rows, "
+          f"{docs_size / store_size:.1f}x smaller)")
@@ -0,0 +1,45 @@
+'''
+Times stats.get_top_students with the hash indexes against the previous
+TinyDB scan per student, on the bundled db.json.
+'''
+import contextlib
+import io
+import time
+
+from tinydb import where
+
+import stats
+
+
+def scan_top_students(n=20):
+    '''The get_top_students loop as it was, one grades_db.search per student.'''
+    top_list = []
+    for student in stats.students_db:
+        scores = stats.grades_db.search(where("num") == student["num"])
+        (n_courses, avg) = stats.student_average(scores)
+        if n_courses == len(stats.whilelist2):
+            top_list.append((student["name"], (n_courses, avg)))
+
+    top_list.sort(key=lambda e: e[1][1], reverse=True)
+
+    for (name, (n, avg)) in top_list[:n]:
+        print(f"{name} - {avg:.2f} {n}")
+
+
+def timed(f, *args):
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        f(*args)
+    return time.perf_counter() - start, out.getvalue()
+
+
+if __name__ == "__main__":
+    scan_time, scan_out = timed(scan_top_students)
+    index_time, _ = timed(stats.build_indexes)
+    top_time, top_out = timed(stats.get_top_students)
+
+    print(f"same output: {scan_out == top_out}")
+    print(f"TinyDB scan:   {scan_time * 1000:8.1f} ms")
+    print(f"build indexes: {index_time * 1000:8.1f} ms")
+    print(f"indexed query: {top_time * 1000:8.1f} ms")
@@ -1,6 +1,9 @@
 #!/usr/bin/python3
+import argparse
 import configparser
 import datetime
+import hashlib
+import random
 from logging import log
 from pyclbr import Function
 from re import fullmatch, sub
@@ -12,9 +15,22 @@ import json
 import requests
 from requests import Response
 from requests.sessions import Session
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 import logging
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+from requests import PreparedRequest
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo
+from typing import Optional
+import metrics
+from client import InforClient
+from page_cache import ParseCache
+import ratelimit
+from ratelimit import TokenBucket
 
 config = None
 configs_file_name = 'configs.ini'
@@ -27,6 +43,9 @@ infor_subjects_url = infor_base_url + \
     "/nonio/inscturmas/listaInscricoes.do?args=5189681149284684"
 infor_pautas_url = infor_base_url + "/nonio/pautas/pesquisaPautas.do"
 infor_init_url = infor_base_url + "/security/init.do"
+page_cache = ParseCache()
+client = InforClient(infor_base_url)
+server_timezone = ZoneInfo("Europe/Lisbon")
 relevant_zone_titles = [
     "Teórico-Prática",
     "Teórico-Práticas",
@@ -44,6 +63,7 @@ class Subject():
     semester: str
     href: str
     url: str
+    text: str
 
     @staticmethod
     def fromBSTableList(elems: List):
@@ -60,6 +80,35 @@ class Subject():
 
         return d
 
+    def toRecord(self) -> List:
+        return [self.number, self.name, self.semester, self.href, self.text]
+
+    def opens_at(self) -> Optional[float]:
+        '''
+        Epoch of the enrolment opening shown in the listing row, e.g.
+        '11-02-2021 13:00' (the first date, the second one is the closing).
+        '''
+        dates = self.dates()
+        return dates[0] if dates else None
+
+    def closes_at(self) -> Optional[float]:
+        '''Epoch of the enrolment closing shown in the listing row.'''
+        dates = self.dates()
+        return dates[1] if len(dates) > 1 else None
+
+    def dates(self) -> List[float]:
+        return [datetime.datetime.strptime(d, "%d-%m-%Y %H:%M")
+                .replace(tzinfo=server_timezone).timestamp()
+                for d in re.findall(r"\d{2}-\d{2}-\d{4} \d{2}:\d{2}", self.text or "")]
+
+    @staticmethod
+    def fromRecord(record: List):
+        d = Subject()
+        d.number, d.name, d.semester, d.href, d.text = record
+        d.url = gen_link(infor_subjects_url,
+                         d.href) if d.href is not None else None
+        return d
+
     def __repr__(self) -> str:
         return "{} {} {} {}".format(
             self.semester, self.number, self.name, self.url
@@ -77,10 +126,11 @@ class Form():
                              'org.apache.struts.taglib.html.CANCEL']
         f = Form()
         f.id = form["id"]
-        f.action_url = gen_link(infor_base_url, form["action"])
+        f.action_url = infor_base_url + form["action"]
+        f.inputs = {}
         inputs = form.find_all("input")
         for i in inputs:
-            if i['name'] in irrelevant_inputs:
+            if i.get('name') is None or i['name'] in irrelevant_inputs:
                 continue
             if i['name'] not in f.inputs:
                 f.inputs[i['name']] = [i.attrs]
@@ -89,16 +139,91 @@ class Form():
 
         return f
 
+    def toRecord(self) -> List:
+        return [self.id, self.action_url, self.inputs]
+
+    @staticmethod
+    def fromRecord(record: List):
+        f = Form()
+        f.id, f.action_url, f.inputs = record
+        return f
+
     def __repr__(self) -> str:
         return f"{self.id}\t{self.action_url}\t{self.inputs}"
 
 
+@dataclass
+class ZoneRow():
+    '''
+    A row of a zone (turmas) table. cols are the whitespace collapsed cell
+    texts, turma_input the (name, value) of the enrolment input, None when
+    the turma can't be chosen, and value the value of the first input.
+    '''
+    text: str
+    cols: List[str]
+    turma_input: Optional[List[str]]
+    value: Optional[str]
+
+    @staticmethod
+    def fromBSRow(row: BeautifulSoup):
+        cols = [re.sub(r'\s+', ' ', col.text) for col in row.find_all("td")]
+        inp = row.find(is_turma_tag)
+        turma_input = [inp['name'], inp['value']] if inp is not None else None
+        first = row.find('input')
+        value = first.get('value') if first is not None else None
+        return ZoneRow(row.text, cols, turma_input, value)
+
+
+@dataclass
+class Zone():
+    title: str
+    rows: Optional[List[ZoneRow]]
+
+
+@dataclass
+class SubjectPage():
+    '''
+    The parts of a subject enrolment page the bot uses.
+    '''
+    form: Form
+    zones: List[Zone]
+
+    def toRecord(self) -> Dict:
+        return {"form": self.form.toRecord(),
+                "zones": [[z.title, None if z.rows is None else
+                           [[r.text, r.cols, r.turma_input, r.value] for r in z.rows]]
+                          for z in self.zones]}
+
+    @staticmethod
+    def fromRecord(record: Dict):
+        zones = [Zone(title, None if rows is None else [ZoneRow(*r) for r in rows])
+                 for title, rows in record["zones"]]
+        return SubjectPage(Form.fromRecord(record["form"]), zones)
+
+
 @dataclass
 class Payload():
+    '''
+    The enrolment POST data for turma. options are the (turma, data) of
+    every wanted turma of the zone, in order of preference.
+    '''
     subject: Subject
     form_url: str
     payload: Dict
     turma: str
+    account: Optional[str] = None
+    options: List[Tuple[str, Dict]] = field(default_factory=list)
+
+
+@dataclass
+class Account():
+    '''
+    Login and turmas preferences of one student.
+    '''
+    name: str
+    username: str
+    password: str
+    turmas_file_name: str = turmas_file_name
 
 
 def NoneIfException(f: Function, *args):
@@ -113,7 +238,7 @@ def NoneIfException(f: Function, *args):
 
 
 def is_turma_tag(tag: BeautifulSoup) -> bool:
-    return tag.name == 'input' and \
+    return tag.name == 'input' and tag.has_attr('name') and \
         not tag['name'] == 'visibilidade' and \
         not tag['name'] == "org.apache.struts.taglib.html.CANCE"
 
@@ -134,9 +259,8 @@ def gen_link(path: str, dest: str) -> str:
     return full_path
 
 
-def load_configs() -> configparser.ConfigParser:
+def load_configs(configs_file_name: str = configs_file_name) -> configparser.ConfigParser:
     '''Load configurations from the default configs.ini file'''
-    global configs_file_name
     config = configparser.ConfigParser()
     defaults = {
         'DEFAULT': {
@@ -154,13 +278,15 @@ def load_configs() -> configparser.ConfigParser:
         return None
 
     def valid_user_info() -> bool:
+        # every section is an account, see load_accounts
         errors = False
-        for val in ('username', 'password'):
-            if val not in config.defaults():
-                logging.info(
-                    f'Config file doesnt have the {val}. Please fill it in')
-                config.defaults()[val] = defaults['DEFAULT'][val]
-                errors = True
+        for section in config.sections() or [config.default_section]:
+            for val in ('username', 'password'):
+                if val not in config[section]:
+                    logging.info(
+                        f'Config file doesnt have the {val} for {section}. Please fill it in')
+                    config[section][val] = defaults['DEFAULT'][val]
+                    errors = True
         return not errors
 
     try:
@@ -182,63 +308,135 @@ def load_configs() -> configparser.ConfigParser:
         return None
 
 
-def login(session: Session) -> Tuple[bool, Response]:
-    # GET infor page
-    r = session.get(infor_login_url)
-    if r.status_code != 200:
-        return (False, r)
+def load_accounts(config: configparser.ConfigParser) -> List[Account]:
+    '''
+    Every section of the config is an account, with its own username,
+    password and turmas file (turmas = ...). Values missing in a section
+    come from DEFAULT, so a config without sections is a single account.
+    '''
+    sections = config.sections() or [config.default_section]
+    accounts = []
+    for name in sections:
+        section = config[name]
+        accounts.append(Account(
+            section['username'] if name == config.default_section else name,
+            section['username'],
+            section['password'],
+            section.get('turmas', turmas_file_name)))
+    return accounts
 
-    page = BeautifulSoup(r.text, 'html.parser')
-    cookie = r.headers["Set-Cookie"].split()[0]
-    # TODO the cookie is set in the request itself
-    session.headers.update({"Cookie": cookie})
 
-    login_form = page.find(id="loginFormBean")
-    action = login_form["action"]
+def default_account() -> Account:
+    return Account(config.defaults()['username'],
+                   config.defaults()['username'],
+                   config.defaults()['password'])
 
-    login_url = infor_base_url + action
 
-    # POST login attempt
-    form_data = {
-        "username": config.defaults()['username'],
-        "password": config.defaults()['password']}
-    r = session.post(login_url, data=form_data)
+def login(session: Session, account: Account = None) -> Tuple[bool, Response]:
+    # sessions remember their account so a relogin uses the same one
+    account = account or getattr(session, "account", None) or default_account()
+    session.account = account
+    return client.login(session, account.username, account.password)
 
-    if r.status_code != 200:
-        return (False, r)
 
-    # Check if correctly authenticated
-    page = BeautifulSoup(r.text, 'html.parser')
-    errors_div = page.find(id="div_erros_preenchimento_formulario")
-    if errors_div is not None:
-        error_text = errors_div.div.ul.li.text
-        logging.info(error_text)
-        return (False, r)
-    return (True, r)
+class SessionManager():
+    '''
+    Keeps a session logged in. Tracks the age of the login cookie, checks
+    the session with a cheap authenticated probe and, from a background
+    thread, logs in again before max_age or as soon as a probe fails.
+    generation counts the logins, a user of the session that sees it change
+    knows the server state of the old login (an open form) is gone.
+    '''
+
+    def __init__(self, session: Session, account: Account = None,
+                 max_age: float = 20 * 60, check_interval: float = 60):
+        self.session = session
+        self.account = account
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.logins = 0
+        self.relogins = 0
+        self.failed_logins = 0
+        self.generation = 0
+        self.login_latencies: List[float] = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def age(self) -> float:
+        logged_in_at = getattr(self.session, "logged_in_at", None)
+        return float("inf") if logged_in_at is None else time.time() - logged_in_at
+
+    def login(self) -> bool:
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                success, _ = login(self.session, self.account)
+            except requests.RequestException as e:
+                logging.info(f"Login failed: {e}")
+                success = False
+            self.login_latencies.append((time.perf_counter() - start) * 1000)
+            if not success:
+                self.failed_logins += 1
+                metrics.registry.inc("logins_total", result="failed")
+                return False
+            if self.logins:
+                self.relogins += 1
+                metrics.registry.inc("logins_total", result="relogin")
+            self.logins += 1
+            self.generation += 1
+            return True
+
+    def probe(self) -> bool:
+        '''
+        True if the server still knows the session. An expired one is
+        redirected to the login page. The dashboard is probed, not the
+        inscturmas pages, which would close a form open in the session.
+        '''
+        try:
+            r = self.session.get(client.dashboard_url,
+                                 allow_redirects=False, timeout=10)
+        except requests.RequestException:
+            return False
+        return r.status_code == 200
+
+    def ensure(self) -> Session:
+        '''
+        Returns the session after making sure it is logged in.
+        '''
+        if self.age() > self.max_age or not self.probe():
+            logging.info("Session expired, logging in again")
+            self.login()
+        return self.session
+
+    def start(self) -> "SessionManager":
+        if getattr(self.session, "logged_in_at", None) is not None:
+            self.logins += 1
+        else:
+            self.login()
+
+        def run():
+            while not self.stopped.wait(self.check_interval):
+                # relogin early rather than let an attempt hit an expired session
+                if self.age() > self.max_age - self.check_interval or not self.probe():
+                    self.login()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self) -> Dict:
+        latencies = self.login_latencies
+        return {"logins": self.logins, "relogins": self.relogins,
+                "failed_logins": self.failed_logins,
+                "login_latency_ms": sum(latencies) / len(latencies) if latencies else None}
 
 
 def navigate_subjects_page(session: Session, relogin: bool = True) -> Tuple[bool, Response]:
     # Get list of classes
-    r = session.get(infor_insc_turmas_url)
-    if r.status_code != 200:
-        logging.info(r.status_code)
-        return False, None
-    if r.url is not infor_insc_turmas_url:
-        logging.info("Navigate to subjects page failed. Relogin and retry")
-        sucess, res = login(session)
-
-    page = BeautifulSoup(r.text, 'html.parser')
-    # TODO avisar caso LEI não se a primeira
-    # quickfix
-
-    next_link_part = page.find(id="link_0").a["href"]
-    url = gen_link(infor_insc_turmas_url, next_link_part)
-    r = session.post(url)
-    if r.status_code != 200:
-        logging.info(r.status_code)
-        return False, None
-
-    return True, r
+    return client.inscturmas(session, relogin)
 
 
 def extract_subjects(res: Response) -> List[Subject]:
@@ -246,7 +444,12 @@ def extract_subjects(res: Response) -> List[Subject]:
     Extracts the subjects from the http response containing the 'listaInscricoesFormBean'.
     Every subject has a url property, in wich the classes (Theory and Practical) can be found.
     '''
-    page = BeautifulSoup(res.text, 'html.parser')
+    records = page_cache.get("subjects", res.url, res.content, parse_subjects)
+    return [Subject.fromRecord(record) for record in records]
+
+
+def parse_subjects(content: bytes) -> List[List]:
+    page = BeautifulSoup(content, 'html.parser')
     subjects_form = page.find(id="listaInscricoesFormBean")
     if subjects_form is None:
         raise Exception('Cant find the subjects list')
@@ -254,13 +457,12 @@ def extract_subjects(res: Response) -> List[Subject]:
         class_="displaytable").tbody.find_all("tr")
 
     # Filter
-
-    subjects = [Subject.fromBSTableList([i for i in row if i != "\n"])
-                for row in subjects_table_rows]
-    for sub in subjects:
-        sub.url = gen_link(infor_subjects_url,
-                           sub.href) if sub.href is not None else None
-    return subjects
+    records = []
+    for row in subjects_table_rows:
+        subject = Subject.fromBSTableList([i for i in row if i != "\n"])
+        subject.text = row.text
+        records.append(subject.toRecord())
+    return records
 
 
 def extract_title_and_rows(zone: BeautifulSoup) -> Tuple[str, List[BeautifulSoup]]:
@@ -283,117 +485,328 @@ def extract_title_and_rows(zone: BeautifulSoup) -> Tuple[str, List[BeautifulSoup
     return zone_title, zone_rows
 
 
-def get_subject_form(subject: Subject) -> BeautifulSoup:
-    r = session.get(subject.url)
-    if r.status_code != 200:
-        return False
-
-    page = BeautifulSoup(r.text, 'html.parser')
+def parse_subject_page(content: bytes) -> Optional[Dict]:
+    page = BeautifulSoup(content, 'html.parser')
     form = page.find(id="listaInscricoesFormBean")
     if form is None:
         form = page.find(id="inscreverFormBean")
     if form is None:
+        return None
+
+    zones = []
+    for zone in form.find_all(class_="zone"):
+        zone_title, zone_rows = extract_title_and_rows(zone)
+        if zone_rows is not None:
+            zone_rows = [ZoneRow.fromBSRow(row) for row in zone_rows]
+        zones.append(Zone(zone_title, zone_rows))
+    return SubjectPage(Form.fromBSForm(form), zones).toRecord()
+
+
+def get_subject_page(subject: Subject, session: Session) -> Optional[SubjectPage]:
+    r = session.get(subject.url)
+    if r.status_code != 200:
+        return None
+
+    record = page_cache.get("subject", subject.url,
+                            r.content, parse_subject_page)
+    if record is None:
         logging.error(
             f"Something went wrong. Cant find the enrolement form for {subject.name}")
         return None
-    return form
+    return SubjectPage.fromRecord(record)
 
 
-def find_class_row(rows: List[BeautifulSoup], turma: str) -> BeautifulSoup:
-    options = list(filter(lambda c: turma in c.text, rows))
+def find_class_row(rows: List[ZoneRow], turma: str) -> ZoneRow:
+    # the turma cell first, "PL1" is also in the text of "PL10"
+    options = [r for r in rows if r.cols and r.cols[0].strip() == turma]
+    if not options:
+        options = list(filter(lambda c: turma in c.text, rows))
     if not options:
         return None
     return options[0]
 
 
-def gen_subject_configs(subjects: List[Subject], session: Session) -> bool:
+def wanted_turmas(zone_config: Dict) -> List[str]:
     '''
-    Generates the configuration file to be used for chosing the class.
-    Returns True if no errors have occured, False otherwise.
+    The "want" of a zone in turmas.json, a turma or a list of turmas in
+    order of preference.
     '''
+    want = zone_config.get("want")
+    if isinstance(want, str):
+        return [want]
+    return list(want or [])
 
-    subjects_info = {}
 
-    for subject in [s for s in subjects if s.url is not None]:
-        logging.info(f"Subject: {subject.name}")
-        info = {}
-        info["last-updated"] = str(datetime.datetime.now())
+def row_seats(row: ZoneRow) -> int:
+    seats = row.cols[-3].strip() if len(row.cols) >= 3 else ""
+    return int(seats) if seats.isnumeric() else 0
 
-        form = get_subject_form(subject)
 
-        zones = form.find_all(class_="zone")
+def row_payload(row: ZoneRow) -> Dict:
+    if row.turma_input is None:
+        # Extract input value from the horarios input
+        return {"inscrever": row.value}
+    name, value = row.turma_input
+    return {name: value}
 
-        for zone in zones:
-            zone_title, zone_rows = extract_title_and_rows(zone)
-            if zone_rows is None:
-                continue
-            if zone_title not in relevant_zone_titles:
-                continue
-            info[zone_title] = {"want": "ESCOLHE UMA OPCAO", "options": []}
-            for row in zone_rows:
-                zone_cols = row.find_all("td")
-                if not zone_cols:
-                    continue
-                info[zone_title]["options"].append(
-                    re.sub(r'\s+', ' ', zone_cols[0].text))
-                row_text = "\t".join(re.sub(r'\s+', ' ', col.text)
-                                     for col in zone_cols)
-                logging.info("\t" + row_text)
 
-        subjects_info[subject.name] = info
-    with open(turmas_file_name, "w") as f:
-        json.dump(subjects_info, f, sort_keys=True, indent=4)
-    return True
+@lru_cache(maxsize=64)
+def seats_pattern(turmas: Tuple[str, ...]) -> re.Pattern:
+    names = b"|".join(re.escape(t.encode()) for t in turmas)
+    return re.compile(rb"<td[^>]*>\s*(" + names +
+                      rb")\s*</td>(?:\s*<td[^>]*>[^<]*</td>){2}\s*<td[^>]*>\s*(\d+)\s*</td>")
 
 
-def do_register(subjects: List[Subject], session: Session, time=5):
+def parse_seats(content: bytes, turmas: List[str]) -> Dict[str, int]:
+    '''
+    Free seats of the given turmas in a subject page. Only the seats cell of
+    their rows is read, with a regex, instead of parsing the whole page.
+    '''
+    return {m.group(1).decode(): int(m.group(2))
+            for m in seats_pattern(tuple(turmas)).finditer(content)}
+
+
+def listing_fingerprint(subject: Subject) -> str:
+    '''
+    Hash of the subject row in the listing. The row changes with the subject
+    (enrolment dates, the current turma), so an unchanged row means the
+    stored options are still good.
+    '''
+    return hashlib.sha1((subject.text or "").encode()).hexdigest()
+
+
+def subject_config(subject: Subject, session: Session, old: Dict = None) -> Optional[Dict]:
+    '''
+    The turmas.json entry of a subject, from its page. The "want" of the
+    zones in old is kept. None if the page could not be read.
+    '''
+    old = old or {}
+    page = get_subject_page(subject, session)
+    if page is None:
+        return None
+
+    info = {}
+    info["last-updated"] = str(datetime.datetime.now())
+    info["listing"] = listing_fingerprint(subject)
+    for zone in page.zones:
+        if zone.rows is None:
+            continue
+        if zone.title not in relevant_zone_titles:
+            continue
+        want = old.get(zone.title, {}).get("want", "ESCOLHE UMA OPCAO")
+        info[zone.title] = {"want": want, "options": []}
+        for row in zone.rows:
+            if not row.cols:
+                continue
+            info[zone.title]["options"].append(row.cols[0])
+            logging.info("\t" + "\t".join(row.cols))
+    return info
+
+
+def diff_options(old: Dict, new: Dict) -> Dict[str, Tuple[List[str], List[str]]]:
+    '''
+    zone title -> (options that appeared, options that disappeared) between
+    two turmas.json entries of a subject, for the zones that changed.
+    '''
+    changes = {}
+    for title in set(old) | set(new):
+        before = old.get(title)
+        after = new.get(title)
+        if not isinstance(before or after, dict):
+            continue
+        before = (before or {}).get("options", [])
+        after = (after or {}).get("options", [])
+        appeared = [o for o in after if o not in before]
+        disappeared = [o for o in before if o not in after]
+        if appeared or disappeared:
+            changes[title] = (appeared, disappeared)
+    return changes
+
+
+def gen_subject_configs(subjects: List[Subject], session: Session,
+                        file_name: str = None, force: bool = False,
+                        workers: int = 4) -> bool:
+    '''
+    Generates the configuration file to be used for chosing the class.
+    An existing file is refreshed: only the subjects whose listing row
+    changed are fetched again (every subject with force), workers at a
+    time, and the chosen "want" of every zone is kept. The server keeps
+    the open subject form per session, so every worker past the first
+    logs in its own session.
+    Returns True if no errors have occured, False otherwise.
+    '''
+    file_name = file_name or turmas_file_name
     try:
-        turmas = json.load(open(turmas_file_name))
+        with open(file_name) as f:
+            stored = json.load(f)
     except FileNotFoundError:
-        logging.info(
-            "turmas file file not found. Running gen_subject_configs first")
-        gen_subject_configs(subjects, session)
-        return do_register(subjects, session)
-    except:
-        raise
+        stored = {}
+
+    listed = [s for s in subjects if s.url is not None]
+    stale = [s for s in listed if force or s.name not in stored
+             or stored[s.name].get("listing") != listing_fingerprint(s)]
+    logging.info(f"{len(stale)} of {len(listed)} subjects changed")
+
+    workers = max(1, min(workers, len(stale)))
+    sessions = [session] + [new_session(getattr(session, "account", None))
+                            for _ in range(workers - 1)]
+    sessions = [s for s in sessions if s is not None]
+    free = queue.SimpleQueue()
+    for s in sessions:
+        free.put(s)
+
+    def fetch(subject: Subject) -> Optional[Dict]:
+        s = free.get()
+        try:
+            return subject_config(subject, s, stored.get(subject.name))
+        finally:
+            free.put(s)
+
+    with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        infos = list(executor.map(fetch, stale))
+
+    ok = True
+    subjects_info = {s.name: stored[s.name] for s in listed if s.name in stored}
+    for subject, info in zip(stale, infos):
+        if info is None:
+            ok = False
+            continue
+        old = stored.get(subject.name, {})
+        for title, (appeared, disappeared) in sorted(diff_options(old, info).items()):
+            logging.info(f"{subject.name} - {title}: "
+                         f"+[{', '.join(appeared)}] -[{', '.join(disappeared)}]")
+            gone = [t for t in wanted_turmas(info.get(title, {})) if t in disappeared]
+            if gone:
+                logging.warning(f"{subject.name} - {title}: wanted {', '.join(gone)} is gone")
+        subjects_info[subject.name] = info
+    for name in stored.keys() - subjects_info.keys():
+        logging.info(f"{name} is no longer listed")
+
+    with open(file_name, "w") as f:
+        json.dump(subjects_info, f, sort_keys=True, indent=4)
+    page_cache.save()
+    return ok
 
+
+def gen_payloads(subjects: List[Subject], session: Session, turmas: Dict,
+                 account: str = None) -> Deque[Payload]:
+    '''
+    Builds the enrolment POST of every subject with a chosen turma.
+    '''
     payloads: Deque[Payload] = Deque()
-    # Generate payloads
     for subject in [s for s in subjects if s.url is not None]:
         if subject.name not in turmas:
             continue
-        form = get_subject_form(subject)
-        form_url = infor_base_url + form['action']
-
-        zones = form.find_all(class_="zone")
+        page = get_subject_page(subject, session)
+        if page is None:
+            continue
+        form_url = page.form.action_url
 
-        for zone in zones:
-            zone_title, zone_rows = extract_title_and_rows(zone)
-            if zone_rows is None:
+        for zone in page.zones:
+            if zone.rows is None:
                 continue
-            turma = turmas[subject.name][zone_title]["want"]
-            option = find_class_row(zone_rows, turma)
-            if option is None:
+            wanted = wanted_turmas(turmas[subject.name][zone.title])
+            options = [(turma, find_class_row(zone.rows, turma)) for turma in wanted]
+            options = [(turma, row) for turma, row in options if row is not None]
+            if not options:
                 logging.info(
-                    f"No option {turma} for {zone_title} in {subject.name}")
+                    f"No option {', '.join(wanted)} for {zone.title} in {subject.name}")
                 continue
 
-            inp = option.find(is_turma_tag)
-            if inp is None:
+            # the most preferred turma with seats, else the most preferred
+            turma, option = next(((t, row) for t, row in options if row_seats(row) > 0),
+                                 options[0])
+            if option.turma_input is None:
                 logging.info(
-                    f"Something went wrong: {option.find_all('td')[-1].text.strip()}")
-                # Extract input value from the horarios input
-                value = option.find('input')['value']
-                p = {"inscrever": value}
-                payloads.append(Payload(subject, form_url, p, turma))
+                    f"Something went wrong: {option.cols[-1].strip()}")
             else:
-                vagas = option.find_all('td')[-3].text
-                logging.info(f"You're in luck, a turma ainda tem {vagas}")
-                p = {inp['name']: inp['value']}
-                payloads.append(Payload(subject, form_url, p, turma))
+                vagas = option.cols[-3]
+                logging.info(f"You're in luck, a turma {turma} ainda tem {vagas}")
+            payloads.append(
+                Payload(subject, form_url, row_payload(option), turma, account,
+                        [(t, row_payload(row)) for t, row in options]))
             break
 
+    page_cache.save()
     logging.info(f"Payloads ready, number of payloads: {len(payloads)}.")
+    return payloads
+
+
+def load_turmas(subjects: List[Subject], session: Session, file_name: str = None) -> Dict:
+    file_name = file_name or turmas_file_name
+    try:
+        return json.load(open(file_name))
+    except FileNotFoundError:
+        logging.info(
+            "turmas file file not found. Running gen_subject_configs first")
+        gen_subject_configs(subjects, session, file_name)
+        return json.load(open(file_name))
+
+
+def registration_outcome(r: Response, p: Payload) -> str:
+    '''
+    Classifies the response to an enrolment POST:
+    "registered" - the listing shows the wanted turma
+    "not-open" - back in the listing but still in another turma
+    "not-yet" - the server rendered the form again
+    "error" - anything else
+    '''
+    if r.status_code != 200:
+        logging.error("Something went wrong")
+        return "error"
+    if r.url == infor_insc_turmas_base + "listaInscricoes.do":
+        # TODO: verificar se está de facto inscrito, pode ser que não há inscrições a decorrer.
+        subject_row = next(
+            (s for s in extract_subjects(r) if p.subject.name in s.text), None)
+        if subject_row is None:
+            logging.error(f"{p.subject.name} is not in the subjects list")
+            return "error"
+        # whole words, "TP1" is also in the text of "TP10"
+        if p.turma in re.split(r"[\s,;]+", subject_row.text):
+            return "registered"
+        logging.info(f"Current: {subject_row.text}")
+        turma_current = [
+            i for i in subject_row.text.strip().split("\n") if p.turma[:-1] in i]
+        if turma_current:
+            logging.info(
+                f"Not yet.. still in {turma_current[0]}.")
+        else:
+            #['01000068', 'Análise Matemática II\xa0*', '2.º Semestre', 'T1', '11-02-2021 13:00', '11-02-2021 23:49', 'Inscrições']
+            logging.info(f"Not yet.. inscrições a não estão a decorrer maybe?")
+        return "not-open"
+    if r.url == infor_insc_turmas_base + "inscrever.do?method=submeter":
+        logging.info("Not yet.. trying again")
+        return "not-yet"
+    logging.error(
+        "Something went wrong. Should not have been redirected here")
+    return "error"
+
+
+results_lock = threading.Lock()
+results_file_name = "results.jsonl"
+
+
+def log_success(p: Payload):
+    logging.info("Gotcha!")
+    if p.account is None:
+        with open("success.log", "a") as f:
+            f.write(f"{p.subject.name}  -  {p.turma}\n")
+        return
+    log_result({"event": "registered", "account": p.account,
+                "subject": p.subject.name, "turma": p.turma})
+
+
+def log_result(record: Dict):
+    '''Appends a record to the structured (JSON lines) results log.'''
+    record = {"time": datetime.datetime.now().isoformat(), **record}
+    with results_lock:
+        with open(results_file_name, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def do_register(subjects: List[Subject], session: Session, time=5):
+    turmas = load_turmas(subjects, session)
+    payloads = gen_payloads(subjects, session, turmas)
 
     while payloads:
         p = payloads.popleft()
@@ -403,62 +816,615 @@ def do_register(subjects: List[Subject], session: Session, time=5):
         payload = p.payload
 
         success, res = navigate_subjects_page(session)
-        page = BeautifulSoup(res.text, 'html.parser')
-
-        td = next(t for t in page.find_all(
-            "td", {"class": "contentLeft"}) if subject.name in t.text).parent
-        insc_url = td.find("a")["href"]
-        session.get(infor_insc_turmas_base + insc_url)
+        listed = next(s for s in extract_subjects(res)
+                      if subject.name in s.name)
+        session.get(listed.url)
 
         logging.info(f"Snnipping {subject.name} - {turma}")
         r = session.post(form_url, data=payload)
+        outcome = registration_outcome(r, p)
+        metrics.registry.inc("registration_attempts_total", outcome=outcome)
+        if outcome == "registered":
+            log_success(p)
+            continue
         if r.status_code != 200:
-            logging.error("Something went wrong")
             continue
-        if r.url == "https://inforestudante.uc.pt/nonio/inscturmas/listaInscricoes.do":
-            # TODO: verificar se está de facto inscrito, pode ser que não há inscrições a decorrer.
-            page = BeautifulSoup(r.text, 'html.parser')
-            subjects_form = page.find(id="listaInscricoesFormBean")
-            subjects_table_rows = subjects_form.find(
-                class_="displaytable").tbody.find_all("tr")
-            subject_row = next(
-                r for r in subjects_table_rows if subject.name in r.text)
-            if turma in subject_row.text:
-                logging.info("Gotcha!")
-                with open("success.log", "a") as f:
-                    f.write(f"{subject.name}  -  {turma}")
-                continue
-            else:
-                logging.info(f"Current: {subject_row.text}")
-                turma_current = [
-                    i for i in subject_row.text.strip().split("\n") if turma[:-1] in i]
-                if turma_current:
-                    turma_current = next(turma_current)
-                    logging.info(
-                        f"Not yet.. still in {turma_current}.")
-                else:
-                    #['01000068', 'Análise Matemática II\xa0*', '2.º Semestre', 'T1', '11-02-2021 13:00', '11-02-2021 23:49', 'Inscrições']
-                    logging.info(f"Not yet.. inscrições a não estão a decorrer maybe?")
-        elif r.url == "https://inforestudante.uc.pt/nonio/inscturmas/inscrever.do?method=submeter":
-            logging.info("Not yet.. trying again")
-            r = session.get(
-                "https://inforestudante.uc.pt/nonio/inscturmas/listaInscricoes.do")
+        if outcome == "not-yet":
+            r = session.get(infor_insc_turmas_base + "listaInscricoes.do")
             r = session.get(subject.url)
-        else:
-            logging.error(
-                "Something went wrong. Should not have been redirected here")
-            # TODO recover and re-start process
         payloads.append(p)  # add to end of list
+        metrics.registry.inc("registration_retries_total")
         sleep(time)
 
     logging.info("Done")
 
 
+@dataclass
+class Attempt():
+    subject: str
+    turma: str
+    outcome: str
+    latency: float  # ms from sending the POST to its first response byte
+
+
+class Backoff():
+    '''
+    Adaptive delay between registration attempts. Errors (or a slow server)
+    multiply the delay, normal answers bring it back towards the minimum.
+    '''
+
+    def __init__(self, minimum: float = 0.25, maximum: float = 10, factor: float = 2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = minimum
+
+    def next(self, outcome: str) -> float:
+        if outcome == "error":
+            self.delay = min(self.maximum, self.delay * self.factor)
+        else:
+            self.delay = max(self.minimum, self.delay / self.factor)
+        # jitter so the sessions don't all fire at the same instant
+        return self.delay * random.uniform(0.8, 1.2)
+
+
+def configure_session(session: Session, limiter: TokenBucket = None, pool_size: int = 2):
+    '''
+    Mounts the connection pool used for inforestudante, rate limited by
+    limiter (the shared adaptive limiter of the server by default) with the
+    urgent priority, and records the metrics of every response. The pool is
+    the session's own and never blocks, a shot must not wait for a
+    connection.
+    '''
+    client.configure(session, client.new_adapter(pool_size, limiter, block=False,
+                                                 priority=ratelimit.urgent))
+
+
+def new_session(account: Account = None, limiter: TokenBucket = None) -> Optional[Session]:
+    '''
+    Creates and logs in a new independent session.
+    '''
+    s = requests.Session()
+    s.hooks['response'].append(log_status)
+    configure_session(s, limiter)
+    success, _ = login(s, account)
+    if not success:
+        logging.info("Login attempt failed")
+        return None
+    return s
+
+
+@dataclass
+class Shot():
+    '''
+    A payload turned into ready to send requests for one session: the
+    navigation that opens the subject form on the server and the POST.
+    '''
+    payload: Payload
+    navigation: List[PreparedRequest]
+    post: PreparedRequest
+
+
+def prepare_shot(p: Payload, session: Session) -> Optional[Shot]:
+    '''
+    Resolves the navigation urls for the payload subject (the LEI listing
+    link and the subject link in it) and prepares every request.
+    '''
+    success, res = navigate_subjects_page(session)
+    if not success:
+        return None
+    listing_url = (res.history[0] if res.history else res).request.url
+    listed = next((s for s in extract_subjects(res)
+                   if p.subject.name in s.name), None)
+    if listed is None or listed.url is None:
+        logging.error(f"{p.subject.name} is not in the subjects list")
+        return None
+
+    navigation = [
+        session.prepare_request(requests.Request("GET", infor_insc_turmas_url)),
+        session.prepare_request(requests.Request("POST", listing_url)),
+        session.prepare_request(requests.Request("GET", listed.url))]
+    post = session.prepare_request(
+        requests.Request("POST", p.form_url, data=p.payload))
+    return Shot(p, navigation, post)
+
+
+def arm(shot: Shot, session: Session) -> bool:
+    '''
+    Opens the subject form on the server side, which has to happen before
+    the enrolment POST is accepted. False if it could not be opened.
+    '''
+    try:
+        for request in shot.navigation:
+            if session.send(with_session_cookie(request, session)).status_code != 200:
+                return False
+    except requests.RequestException as e:
+        logging.error(f"{shot.payload.subject.name}: {e}")
+        return False
+    return True
+
+
+def with_session_cookie(request: PreparedRequest, session: Session) -> PreparedRequest:
+    '''
+    Copy of a prepared request with the current session cookie, which
+    changes when the session logs in again.
+    '''
+    request = request.copy()
+    if "Cookie" in session.headers:
+        request.headers["Cookie"] = session.headers["Cookie"]
+    return request
+
+
+def fire(shot: Shot, session: Session) -> Tuple[Response, float]:
+    '''
+    Sends the prepared POST and follows the redirect.
+    Returns the final response and the ms from the call to the first byte
+    of the POST response.
+    '''
+    trigger = time.perf_counter()
+    r = session.send(with_session_cookie(shot.post, session),
+                     allow_redirects=False, stream=True)
+    first_byte = (time.perf_counter() - trigger) * 1000
+    r.content
+    if r.is_redirect:
+        history = [r] + list(session.resolve_redirects(r, r.request))
+        r = history.pop()
+        r.history = history
+    return r, first_byte
+
+
+class WarmPool():
+    '''
+    Keeps size keep-alive connections of the session to inforestudante open
+    by sending cheap HEAD requests in parallel every interval seconds. The
+    session pool must hold at least size connections, see configure_session.
+    '''
+
+    def __init__(self, session: Session, size: int = 2, interval: float = 15):
+        self.session = session
+        self.size = size
+        self.interval = interval
+        self.pings = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def warm(self):
+        def ping(_):
+            try:
+                self.session.head(infor_base_url + "/nonio/", timeout=10)
+            except requests.RequestException as e:
+                logging.info(f"Ping failed: {e}")
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            list(executor.map(ping, range(self.size)))
+        self.pings += 1
+
+    def start(self) -> "WarmPool":
+        self.warm()
+
+        def run():
+            while not self.stopped.wait(self.interval):
+                self.warm()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+
+class SeatPoller():
+    '''
+    Watches the free seats of the wanted turmas of a shot. A poll is the GET
+    of the subject form (the last navigation request, so it also leaves the
+    form open) and only the seats of the wanted rows are read from it.
+    '''
+
+    def __init__(self, shot: Shot, interval: float = 1):
+        self.shot = shot
+        self.interval = interval
+        self.preferences = [turma for turma, _ in shot.payload.options]
+        self.seats: Dict[str, int] = {}
+        self.polls = 0
+        self.last_poll = time.monotonic()
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last_poll >= self.interval
+
+    def poll(self, session: Session) -> bool:
+        '''Updates seats. False if the subject form could not be read.'''
+        self.last_poll = time.monotonic()
+        try:
+            r = session.send(with_session_cookie(self.shot.navigation[-1], session))
+        except requests.RequestException as e:
+            logging.info(f"{self.shot.payload.subject.name}: seats poll failed: {e}")
+            return False
+        if r.status_code != 200:
+            return False
+        with metrics.registry.timer("parse_ms", page="seats"):
+            self.seats = parse_seats(r.content, self.preferences)
+        self.polls += 1
+        return bool(self.seats)
+
+    def best(self, better_than: str = None) -> Optional[str]:
+        '''
+        The most preferred turma with free seats, only looking at the ones
+        preferred to better_than if given.
+        '''
+        for turma in self.preferences:
+            if turma == better_than:
+                return None
+            if self.seats.get(turma, 0) > 0:
+                return turma
+        return None
+
+    def retarget(self, turma: str, session: Session):
+        '''Points the shot POST to turma.'''
+        p = self.shot.payload
+        data = dict(p.options)[turma]
+        self.shot.payload = replace(p, turma=turma, payload=data)
+        self.shot.post = session.prepare_request(
+            requests.Request("POST", p.form_url, data=data))
+
+
+def snipe(shot: Shot, session: Session, backoff: Backoff = None,
+          max_attempts: int = None, armed: bool = False,
+          schedule: "Schedule" = None, manager: SessionManager = None,
+          hold: float = None) -> List[Attempt]:
+    '''
+    Keeps firing the prepared POST until the turma is ours. The navigation
+    is only resent when the server lost the subject form. After a "not-yet"
+    answer it is already back on the form, so the POST is just resent.
+    With a schedule it waits for the opening and fires every burst_interval
+    during the burst before falling back to the backoff. With a manager the
+    session is checked, and logged in again if needed, after every error,
+    and the form is opened again whenever the manager logged in again.
+    No POST is sent while the form can not be opened, those attempts are
+    "not-armed".
+
+    With more than one wanted turma the seats are polled every second and
+    the POST goes to the most preferred turma with free seats. Once in a
+    turma that is not the first choice it keeps polling, and only fires
+    again when a more preferred one has free seats, for hold seconds at
+    most and never after the enrolments close (see hold_deadline). The
+    attempts end with the registration of the turma it stays in.
+    '''
+    p = shot.payload
+    backoff = backoff or Backoff()
+    attempts: List[Attempt] = []
+    poller = SeatPoller(shot) if len(p.options) > 1 else None
+    # the turma we are in while waiting for a better one
+    holding = None
+    hold_until = float("inf")
+    minimum = backoff.minimum
+    generation = manager.generation if manager is not None else 0
+    if schedule is not None:
+        attempt = wait_for_window(shot, session, schedule, manager)
+        if attempt is not None:
+            return [attempt]
+        backoff.minimum = backoff.delay = schedule.burst_interval
+    while max_attempts is None or len(attempts) < max_attempts:
+        if schedule is not None and time.time() > schedule.burst_end():
+            backoff.minimum = minimum
+        if poller is not None and (poller.due() or holding is not None):
+            if holding is not None:
+                if max_attempts is not None and poller.polls >= max_attempts:
+                    break
+                if time.time() >= hold_until:
+                    logging.info(f"{p.subject.name}: staying in {holding}")
+                    break
+                sleep(max(0, poller.interval - (time.monotonic() - poller.last_poll)))
+            armed = poller.poll(session)
+            target = poller.best(better_than=holding)
+            if target is None and holding is not None:
+                continue
+            if target is not None and target != p.turma:
+                logging.info(f"{p.subject.name}: switching from {p.turma} to {target} "
+                             f"({poller.seats[target]} free seats)")
+                poller.retarget(target, session)
+                p = shot.payload
+        if attempts:
+            metrics.registry.inc("registration_retries_total")
+        if manager is not None and manager.generation != generation:
+            # a new login, the server forgot the open form
+            generation = manager.generation
+            armed = False
+        if not armed:
+            armed = arm(shot, session)
+        if not armed:
+            # a POST without the open form is wasted, open it first
+            attempts.append(Attempt(p.subject.name, p.turma, "not-armed", 0))
+            metrics.registry.inc("registration_attempts_total", outcome="not-armed")
+            logging.info(f"Snnipping {p.subject.name} - {p.turma}: could not open the form")
+            if manager is not None:
+                session = manager.ensure()
+            sleep(backoff.next("error"))
+            continue
+        try:
+            r, latency = fire(shot, session)
+            outcome = registration_outcome(r, p)
+        except requests.RequestException as e:
+            logging.error(f"{p.subject.name} - {p.turma}: {e}")
+            outcome, latency = "error", 0
+        attempts.append(Attempt(p.subject.name, p.turma, outcome, latency))
+        metrics.registry.inc("registration_attempts_total", outcome=outcome)
+        metrics.registry.observe("registration_first_byte_ms", latency, outcome=outcome)
+        logging.info(
+            f"Snnipping {p.subject.name} - {p.turma}: {outcome} ({latency:.0f} ms to first byte)")
+
+        if outcome == "registered":
+            log_success(p)
+            if poller is None or p.turma == poller.preferences[0]:
+                break
+            holding = p.turma
+            hold_until = hold_deadline(p.subject, hold)
+            armed = False
+            continue
+        if outcome != "not-yet":
+            armed = False
+        if outcome == "error" and manager is not None:
+            session = manager.ensure()
+        sleep(backoff.next(outcome))
+    return attempts
+
+
+def hold_deadline(subject: Subject, hold: float = None) -> float:
+    '''
+    Until when a turma that is not the first choice is held while polling
+    for a better one: hold seconds from now, at most until the enrolments
+    of the subject close.
+    '''
+    deadline = float("inf") if hold is None else time.time() + hold
+    closes_at = subject.closes_at()
+    if closes_at is not None:
+        deadline = min(deadline, closes_at)
+    return deadline
+
+
+def estimate_clock_offset(session: Session, samples: int = 8) -> Tuple[float, float, float]:
+    '''
+    Estimates server clock - local clock from the HTTP Date headers. The
+    header only has seconds, so each sample bounds the offset to a one second
+    window shifted by the round trip; the samples are spread over a second
+    and their windows intersected.
+    Returns the offset, its uncertainty (both in seconds) and the smallest
+    round trip time.
+    '''
+    low, high = -float("inf"), float("inf")
+    min_rtt = float("inf")
+    for i in range(samples):
+        sent = time.time()
+        r = session.head(infor_base_url + "/nonio/", timeout=10)
+        received = time.time()
+        min_rtt = min(min_rtt, received - sent)
+        date = r.headers.get("Date")
+        if date is not None:
+            server = parsedate_to_datetime(date).timestamp()
+            # sent <= stamped <= received and server <= stamped + offset < server + 1
+            low = max(low, server - received)
+            high = min(high, server + 1 - sent)
+        sleep(1 / samples + 0.01)
+    if low > high or low == -float("inf"):
+        logging.info("Could not estimate the server clock, assuming it is in sync")
+        return 0.0, 1.0, min_rtt
+    return (low + high) / 2, (high - low) / 2, min_rtt
+
+
+@dataclass
+class Schedule():
+    '''
+    When to fire. opens_at is in server time, offset = server - local clock.
+    The burst starts uncertainty + lead seconds before the opening (lead is
+    half the round trip, so the POST arrives on time) and lasts burst seconds.
+    '''
+    opens_at: float
+    offset: float = 0
+    uncertainty: float = 0
+    lead: float = 0
+    burst: float = 10
+    burst_interval: float = 0.05
+    poll_interval: float = 60
+
+    def burst_start(self) -> float:
+        '''Local clock time when the burst starts.'''
+        return self.opens_at - self.offset - self.uncertainty - self.lead
+
+    def burst_end(self) -> float:
+        return self.opens_at - self.offset + self.uncertainty + self.burst
+
+
+def wait_for_window(shot: Shot, session: Session, schedule: Schedule,
+                    manager: SessionManager = None) -> Optional[Attempt]:
+    '''
+    Sleeps until the burst starts, firing once every poll_interval in case
+    the enrolments open early. Returns the attempt if one of those polls
+    already got the turma. A failed poll only opens the form again, as does
+    a new login of the manager.
+    '''
+    p = shot.payload
+    generation = manager.generation if manager is not None else 0
+    logging.info(f"{p.subject.name} - {p.turma}: burst at "
+                 f"{datetime.datetime.fromtimestamp(schedule.burst_start())} local time")
+    while True:
+        remaining = schedule.burst_start() - time.time()
+        if remaining <= 0:
+            return None
+        sleep(min(remaining, schedule.poll_interval))
+        if schedule.burst_start() - time.time() <= 0:
+            return None
+        if manager is not None and manager.generation != generation:
+            generation = manager.generation
+            arm(shot, session)
+        try:
+            r, latency = fire(shot, session)
+        except requests.RequestException as e:
+            logging.error(f"{p.subject.name} - {p.turma}: {e}")
+            arm(shot, session)
+            continue
+        outcome = registration_outcome(r, p)
+        if outcome == "registered":
+            log_success(p)
+            return Attempt(p.subject.name, p.turma, outcome, latency)
+        if outcome != "not-yet":
+            arm(shot, session)
+
+
+@dataclass
+class Gun():
+    '''
+    A prepared shot with its own logged in session and warm connections.
+    '''
+    shot: Shot
+    session: Session
+    pool: WarmPool
+    manager: SessionManager
+    schedule: Optional[Schedule] = None
+
+
+def prepare_burst(subjects: List[Subject], session: Session,
+                  ping_interval: float = 15, account: Account = None,
+                  limiter: TokenBucket = None, max_sessions: int = 4) -> List[Gun]:
+    '''
+    The prepare phase: builds the payloads, gives each one a logged in
+    session (the server keeps the open subject form per session), prepares
+    its requests, opens the subject form and keeps the connections warm.
+    At most max_sessions sessions log in at a time.
+    '''
+    turmas = load_turmas(subjects, session,
+                         account.turmas_file_name if account else None)
+    payloads = gen_payloads(subjects, session, turmas,
+                            account.name if account else None)
+
+    def prepare(i: int, p: Payload) -> Optional[Gun]:
+        s = session if i == 0 else new_session(account, limiter)
+        if s is None:
+            return None
+        pool = WarmPool(s, interval=ping_interval)
+        shot = prepare_shot(p, s)
+        if shot is None or not arm(shot, s):
+            return None
+        return Gun(shot, s, pool.start(), SessionManager(s, account).start())
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_sessions, len(payloads)))) as executor:
+        guns = list(executor.map(prepare, range(len(payloads)), payloads))
+    for p, gun in zip(payloads, guns):
+        if gun is None:
+            logging.error(f"Could not prepare {p.subject.name} - {p.turma}")
+    return [gun for gun in guns if gun is not None]
+
+
+def fire_burst(guns: List[Gun], max_attempts: int = None,
+               hold: float = None) -> List[Attempt]:
+    '''
+    Snipes with every prepared gun at once. A sniper only returns once its
+    turma is ours (or after max_attempts), so every gun gets its own thread.
+    '''
+    def run(gun: Gun) -> List[Attempt]:
+        try:
+            return snipe(gun.shot, gun.session, max_attempts=max_attempts,
+                         armed=True, schedule=gun.schedule, manager=gun.manager,
+                         hold=hold)
+        finally:
+            gun.pool.stop()
+            gun.manager.stop()
+            stats = gun.manager.stats()
+            logging.info(f"{gun.shot.payload.subject.name} session: {stats['logins']} logins, "
+                         f"{stats['relogins']} relogins, {stats['failed_logins']} failed")
+
+    with ThreadPoolExecutor(max_workers=max(1, len(guns))) as executor:
+        attempts = [a for result in executor.map(run, guns) for a in result]
+    report_attempts(attempts)
+    return attempts
+
+
+def do_register_concurrent(subjects: List[Subject], session: Session,
+                           max_sessions: int = 4, max_attempts: int = None,
+                           account: Account = None, limiter: TokenBucket = None,
+                           hold: float = None) -> List[Attempt]:
+    guns = prepare_burst(subjects, session, account=account, limiter=limiter,
+                         max_sessions=max_sessions)
+    return fire_burst(guns, max_attempts, hold)
+
+
+def do_register_scheduled(subjects: List[Subject], session: Session,
+                          max_sessions: int = 4, burst: float = 10,
+                          poll_interval: float = 60, account: Account = None,
+                          limiter: TokenBucket = None, hold: float = None) -> List[Attempt]:
+    '''
+    Like do_register_concurrent, but every subject waits for its opening
+    time from the listing, corrected by the estimated server clock offset.
+    '''
+    offset, uncertainty, rtt = estimate_clock_offset(session)
+    logging.info(f"Server clock offset {offset * 1000:+.0f} ms "
+                 f"(± {uncertainty * 1000:.0f} ms), round trip {rtt * 1000:.0f} ms")
+    guns = prepare_burst(subjects, session, account=account, limiter=limiter,
+                         max_sessions=max_sessions)
+    for gun in guns:
+        opens_at = gun.shot.payload.subject.opens_at()
+        if opens_at is None:
+            logging.info(f"No opening time for {gun.shot.payload.subject.name}, firing now")
+            continue
+        gun.schedule = Schedule(opens_at, offset, uncertainty, rtt / 2,
+                                burst=burst, poll_interval=poll_interval)
+    return fire_burst(guns, hold=hold)
+
+
+def report_attempts(attempts: List[Attempt]):
+    by_subject: Dict[Tuple[str, str], List[Attempt]] = {}
+    for a in attempts:
+        by_subject.setdefault((a.subject, a.turma), []).append(a)
+    for (subject, turma), subject_attempts in by_subject.items():
+        latencies = sorted(a.latency for a in subject_attempts)
+        outcomes = [a.outcome for a in subject_attempts]
+        logging.info(
+            f"{subject} - {turma}: {len(subject_attempts)} attempts, "
+            f"last {outcomes[-1]}, first byte min {latencies[0]:.0f} ms, "
+            f"median {latencies[len(latencies) // 2]:.0f} ms, max {latencies[-1]:.0f} ms")
+
+
 def log_status(r: Response, *args, **kwargs):
     logging.info(f"{r.request.method} {r.status_code} - {r.url}")
 
 
+def set_base_url(url: str):
+    '''
+    Points the bot to another server, e.g. mock_server.py.
+    '''
+    global infor_base_url, infor_login_url, infor_insc_turmas_url, infor_insc_turmas_base, \
+        infor_subjects_url, infor_pautas_url, infor_init_url
+    infor_base_url = url
+    infor_login_url = infor_base_url + "/nonio/security/login.do"
+    infor_insc_turmas_url = infor_base_url + "/nonio/inscturmas/init.do"
+    infor_insc_turmas_base = infor_base_url + "/nonio/inscturmas/"
+    infor_subjects_url = infor_base_url + \
+        "/nonio/inscturmas/listaInscricoes.do?args=5189681149284684"
+    infor_pautas_url = infor_base_url + "/nonio/pautas/pesquisaPautas.do"
+    infor_init_url = infor_base_url + "/security/init.do"
+    client.set_base_url(url)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="inforestudante turmas bot")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="snipe every subject at once, one session each")
+    parser.add_argument("--scheduled", action="store_true",
+                        help="like --concurrent, but wait for the enrolment opening time")
+    parser.add_argument("--sessions", type=int, default=4,
+                        help="maximum number of sessions logging in at once")
+    parser.add_argument("--hold", type=float, default=600,
+                        help="seconds to keep polling for a preferred turma once in another one")
+    parser.add_argument("--delay", type=float, default=2,
+                        help="seconds between attempts when not concurrent")
+    parser.add_argument("--base-url", default=infor_base_url,
+                        help="server to use, e.g. a mock_server.py url")
+    parser.add_argument("--refresh", action="store_true",
+                        help=f"only update {turmas_file_name} with the subjects that changed")
+    parser.add_argument("--metrics",
+                        help="write the metrics here at the end (.prom for Prometheus text, else JSON lines)")
+    parser.add_argument("--trace", help="JSON lines file to append every HTTP request to")
+    args = parser.parse_args()
+    set_base_url(args.base_url)
+    metrics.trace_file_name = args.trace
+
     # Username configuration
     config = load_configs()
     if config is None:
@@ -472,6 +1438,7 @@ if __name__ == "__main__":
     # Session configuration
     session = requests.Session()
     session.hooks['response'].append(log_status)
+    configure_session(session)
 
     success, res = login(session)
     if not success:
@@ -486,5 +1453,16 @@ if __name__ == "__main__":
     logging.info("Inside classes page")
 
     subjects = extract_subjects(res)
-    #gen_subject_configs(subjects, session)
-    do_register(subjects, session, 2)
+    try:
+        if args.refresh:
+            gen_subject_configs(subjects, session)
+        elif args.scheduled:
+            do_register_scheduled(subjects, session, args.sessions, hold=args.hold)
+        elif args.concurrent:
+            do_register_concurrent(subjects, session, args.sessions, hold=args.hold)
+        else:
+            do_register(subjects, session, args.delay)
+    finally:
+        logging.info("\n" + metrics.summary())
+        if args.metrics:
+            metrics.write(args.metrics)
@@ -0,0 +1,220 @@
+'''
+inforestudante client shared by bot.py and scrap.py: the login flow, the
+inscturmas navigation and the pautas pages.
+
+The sessions of a client share one connection pool by default (HTTP/1.1
+keep-alive, at most max_connections open to the server, requests wait for a
+free one). Every request goes through a rate limiter, the process wide
+adaptive one of the server (ratelimit.shared) unless the client is given
+another, with the client priority. A session can be given its own pool
+instead, as the bot does for every registration session so a scrape never
+takes its warm connections; those sessions still share the limiter, with
+the urgent priority.
+
+InforClient is synchronous and its operations can run from many threads at
+once, every session keeps its own cookie.
+'''
+import logging
+import time
+import urllib.parse
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from bs4 import BeautifulSoup
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.sessions import Session
+
+import metrics
+import ratelimit
+from ratelimit import RateLimitedAdapter, TokenBucket
+
+default_base_url = "https://inforestudante.uc.pt"
+max_connections = 8
+
+
+class SessionExpired(Exception):
+    '''The server sent the login page instead of the one asked for.'''
+
+
+def parse_page(data: bytes, kind: str) -> BeautifulSoup:
+    with metrics.registry.timer("parse_ms", page=kind):
+        return BeautifulSoup(data, 'html.parser')
+
+
+class InforClient():
+    def __init__(self, base_url: str = default_base_url, username: str = "",
+                 password: str = "", max_connections: int = max_connections,
+                 limiter: TokenBucket = None, priority: int = ratelimit.background,
+                 trust_env: bool = True):
+        self.username = username
+        self.password = password
+        self.max_connections = max_connections
+        self.limiter = limiter
+        self.priority = priority
+        # False skips the proxy, CA bundle and .netrc lookup in the
+        # environment on every request (about 0.5 ms each)
+        self.trust_env = trust_env
+        self.shared_adapter: Optional[HTTPAdapter] = None
+        self.set_base_url(base_url)
+
+    @property
+    def adapter(self) -> HTTPAdapter:
+        '''The connection pool shared by the client sessions.'''
+        if self.shared_adapter is None:
+            # block: wait for a free connection instead of opening (and
+            # discarding) extra ones
+            self.shared_adapter = self.new_adapter(self.max_connections)
+        return self.shared_adapter
+
+    def set_base_url(self, url: str):
+        self.base_url = url
+        self.shared_adapter = None
+        self.login_url = url + "/nonio/security/login.do"
+        self.dashboard_url = url + "/nonio/dashboard/dashboard.do"
+        self.insc_turmas_url = url + "/nonio/inscturmas/init.do"
+        self.pautas_base = url + "/nonio/pautas/"
+
+    def new_adapter(self, pool_size: int, limiter: TokenBucket = None,
+                    block: bool = True, priority: int = None) -> HTTPAdapter:
+        limiter = limiter or self.limiter or ratelimit.shared(urlsplit(self.base_url).netloc)
+        return RateLimitedAdapter(limiter, pool_connections=1, pool_maxsize=pool_size,
+                                  pool_block=block,
+                                  priority=self.priority if priority is None else priority)
+
+    def configure(self, session: Session, adapter: HTTPAdapter = None):
+        '''
+        Mounts the shared connection pool (or adapter) for the server and
+        records the metrics of every response.
+        '''
+        session.hooks['response'].append(metrics.response_hook)
+        session.mount(self.base_url, adapter or self.adapter)
+
+    def new_session(self, adapter: HTTPAdapter = None) -> Session:
+        session = requests.Session()
+        session.trust_env = self.trust_env
+        self.configure(session, adapter)
+        return session
+
+    def login(self, session: Session, username: str = None,
+              password: str = None) -> Tuple[bool, Response]:
+        '''
+        Logs the session in, with the client credentials unless others are
+        given. The session remembers them for the relogins. Returns whether
+        it worked and the last response (the dashboard if it did).
+        '''
+        if username is None:
+            username, password = getattr(session, "credentials",
+                                         (self.username, self.password))
+        session.credentials = (username, password)
+        # start a new server session, one that is still valid would not be
+        # given a new cookie
+        session.headers.pop("Cookie", None)
+        session.cookies.clear()
+        r = session.get(self.login_url)
+        if r.status_code != 200:
+            return (False, r)
+
+        page = parse_page(r.content, "login")
+        # TODO the cookie is set in the request itself
+        cookie = r.headers.get("Set-Cookie")
+        if cookie is not None:
+            session.headers.update({"Cookie": cookie.split()[0].rstrip(";")})
+
+        action = page.find(id="loginFormBean")["action"]
+        r = session.post(self.base_url + action,
+                         data={"username": username, "password": password})
+        if r.status_code != 200:
+            return (False, r)
+
+        # Check if correctly authenticated
+        page = parse_page(r.content, "dashboard")
+        errors_div = page.find(id="div_erros_preenchimento_formulario")
+        if errors_div is not None:
+            logging.info(errors_div.div.ul.li.text)
+            return (False, r)
+        session.logged_in_at = time.time()
+        return (True, r)
+
+    def expired(self, r: Response) -> bool:
+        '''True if r was redirected to the login, the session is gone.'''
+        return bool(r.history) and r.url.startswith(self.login_url)
+
+    def inscturmas(self, session: Session, relogin: bool = True) -> Tuple[bool, Optional[Response]]:
+        '''
+        Opens the subjects listing of the first course. If the session
+        expired it logs in again once.
+        '''
+        r = session.get(self.insc_turmas_url)
+        if r.status_code != 200:
+            logging.info(r.status_code)
+            return False, None
+        if r.url != self.insc_turmas_url:
+            if not relogin:
+                return False, None
+            logging.info("Navigate to subjects page failed. Relogin and retry")
+            success, _ = self.login(session)
+            if not success:
+                return False, None
+            return self.inscturmas(session, relogin=False)
+
+        page = parse_page(r.content, "inscturmas")
+        # TODO avisar caso LEI não se a primeira
+        next_link_part = page.find(id="link_0").a["href"]
+        r = session.post(urllib.parse.urljoin(self.insc_turmas_url, next_link_part))
+        if r.status_code != 200:
+            logging.info(r.status_code)
+            return False, None
+        return True, r
+
+    def pautas_url(self, dashboard: Response) -> Optional[str]:
+        '''The pautas link of the dashboard login returned, if logged in.'''
+        m = parse_page(dashboard.content, "dashboard").find(class_="menu_30")
+        if m is None:
+            return None
+        return urllib.parse.urljoin(self.dashboard_url, m.parent['href'])
+
+    def year_info(self, page: BeautifulSoup) -> Tuple[str, str, List[str]]:
+        '''
+        The selected year, the url to select another one and the year options
+        of a pautas year page.
+        '''
+        tr = page.find(id="linhaAnoLectivoMinhasUc")
+        select = tr.contents[3].contents[1]
+        options = [option["value"] for option in select.find_all("option")]
+        year = select.find(selected="selected")["value"]
+        next_arg = select["onchange"].split("'")[1]
+        return year, self.pautas_base + next_arg, options
+
+    def pautas_years(self, session: Session, pautas_url: str,
+                     exclude: List[str] = ()) -> Iterator[Tuple[str, BeautifulSoup]]:
+        '''
+        Yields the (year, page) of every year not in exclude, the current
+        one first. Raises an Exception if a year page can not be fetched.
+        '''
+        r = session.get(pautas_url)
+        if r.status_code != 200:
+            raise Exception(f"GET {pautas_url} status: {r.status_code}")
+        page = parse_page(r.content, "pautas-year")
+        year, next_url, options = self.year_info(page)
+        yield year, page
+
+        for ano in options[1:]:
+            if ano in exclude:
+                continue
+            r = self.select_year(session, next_url, ano)
+            if r.status_code != 200:
+                raise Exception(f"GET ano {ano} status: {r.status_code}")
+            page = parse_page(r.content, "pautas-year")
+            year, next_url, _ = self.year_info(page)
+            yield year, page
+
+    def select_year(self, session: Session, url: str, year: str) -> Response:
+        '''POST of the year select of a pautas page, url from year_info.'''
+        return session.post(url, data={"anoLectivoMinhasUCSeleccionado": year})
+
+    def pauta(self, session: Session, href: str, headers: dict = None,
+              stream: bool = False) -> Response:
+        '''GET of a pauta linked from a year page.'''
+        return session.get(self.pautas_base + href, headers=headers, stream=stream)
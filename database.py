@@ -1,21 +1,23 @@
 import sqlite3
+from contextlib import contextmanager
 from sqlite3 import Connection, Error
+from typing import Iterable, Iterator, List, Sequence, Tuple
 
 create_table_SQL = """
-CREATE TABLE students (
+CREATE TABLE IF NOT EXISTS students (
 	num	 BIGINT,
 	name VARCHAR(512),
 	PRIMARY KEY(num)
 );
 
-CREATE TABLE subjects (
+CREATE TABLE IF NOT EXISTS subjects (
 	id	 BIGINT,
 	name VARCHAR(512),
     sname VARCHAR(6),
 	PRIMARY KEY(id)
 );
 
-CREATE TABLE grades (
+CREATE TABLE IF NOT EXISTS grades (
 	val	 SMALLINT,
 	note	 VARCHAR(512),
 	phase	 VARCHAR(2),
@@ -26,6 +28,40 @@ CREATE TABLE grades (
 	FOREIGN KEY (subject_id) REFERENCES Subjects(id),
 	FOREIGN KEY (student_num) REFERENCES Students(num)
 );
+
+-- covering index of the report.py pivot
+CREATE INDEX IF NOT EXISTS grades_student_subject_val
+ON grades(student_num, subject_id, val, year);
+"""
+
+upsert_students_SQL = """
+INSERT INTO students(num, name) VALUES(?, ?)
+ON CONFLICT(num) DO UPDATE SET name=excluded.name
+WHERE name IS NOT excluded.name
+"""
+
+upsert_subjects_SQL = """
+INSERT INTO subjects(id, name) VALUES(?, ?)
+ON CONFLICT(id) DO UPDATE SET name=excluded.name
+WHERE name IS NOT excluded.name
+"""
+
+grades_columns = "val, note, phase, subject_id, student_num, year"
+
+upsert_grades_SQL = f"""
+INSERT INTO grades({grades_columns}) VALUES(?, ?, ?, ?, ?, ?)
+ON CONFLICT(phase, year, subject_id, student_num) DO UPDATE
+SET val=excluded.val, note=excluded.note
+WHERE val IS NOT excluded.val OR note IS NOT excluded.note
+"""
+
+# "WHERE true" is needed so the ON CONFLICT is not parsed as a join constraint
+upsert_grades_from_staging_SQL = f"""
+INSERT INTO grades({grades_columns})
+SELECT {grades_columns} FROM grades_staging WHERE true
+ON CONFLICT(phase, year, subject_id, student_num) DO UPDATE
+SET val=excluded.val, note=excluded.note
+WHERE val IS NOT excluded.val OR note IS NOT excluded.note
 """
 
 
@@ -57,8 +93,107 @@ def init_database():
             conn.close()
 
 
-def gen_subject_snames():
-    conn = create_conn()
+def batches(rows: Iterable, size: int) -> Iterable[List]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_load(conn: Connection,
+              students: Iterable[Tuple],
+              subjects: Iterable[Tuple],
+              grades: Iterable[Tuple],
+              batch_size: int = 50000,
+              staging_threshold: int = 20000,
+              journal_mode: str = "WAL",
+              synchronous: str = "NORMAL") -> Tuple[int, int, int]:
+    '''
+    Upserts the extracted rows, each batch in its own transaction.
+    students are (num, name), subjects (id, name) and grades are in the
+    grades table column order. Batches bigger than staging_threshold are
+    first copied to a temporary staging table and merged with a single
+    INSERT ... SELECT. The journal_mode and synchronous pragmas are only set
+    for the duration of the load.
+    Returns the number of students, subjects and grades written.
+    '''
+    create_table(conn, create_table_SQL)
+
+    counts = [0, 0, 0]
+    with load_pragmas(conn, journal_mode, synchronous):
+        with conn:
+            counts[0] = upsert(conn, upsert_students_SQL, students)
+            counts[1] = upsert(conn, upsert_subjects_SQL, subjects)
+
+        for batch in batches(grades, batch_size):
+            with conn:
+                counts[2] += upsert_grades(conn, batch, staging_threshold)
+
+    return tuple(counts)
+
+
+@contextmanager
+def load_pragmas(conn: Connection, journal_mode: str = "WAL",
+                 synchronous: str = "NORMAL") -> Iterator[Connection]:
+    '''
+    Sets the journal_mode and synchronous pragmas for the with block and
+    restores the previous ones after it.
+    '''
+    old_journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    old_synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    if journal_mode is not None:
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    if synchronous is not None:
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+    try:
+        yield conn
+    finally:
+        conn.execute(f"PRAGMA synchronous={old_synchronous}")
+        conn.execute(f"PRAGMA journal_mode={old_journal_mode}")
+
+
+def upsert_batch(conn: Connection, students: List[Tuple], subjects: List[Tuple],
+                 grades: List[Tuple], staging_threshold: int = 20000) -> Tuple[int, int, int]:
+    '''
+    Upserts one batch of rows (see bulk_load) in a single transaction.
+    '''
+    with conn:
+        return (upsert(conn, upsert_students_SQL, students),
+                upsert(conn, upsert_subjects_SQL, subjects),
+                upsert_grades(conn, grades, staging_threshold))
+
+
+def upsert_grades(conn: Connection, grades: List[Tuple], staging_threshold: int = 20000) -> int:
+    if len(grades) > staging_threshold:
+        return upsert_staged(conn, grades)
+    return upsert(conn, upsert_grades_SQL, grades)
+
+
+def upsert(conn: Connection, sql: str, rows: Iterable[Sequence]) -> int:
+    before = conn.total_changes
+    conn.executemany(sql, rows)
+    return conn.total_changes - before
+
+
+def upsert_staged(conn: Connection, rows: List[Sequence]) -> int:
+    conn.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS grades_staging({grades_columns})")
+    conn.execute("DELETE FROM grades_staging")
+    conn.executemany(
+        "INSERT INTO grades_staging VALUES(?, ?, ?, ?, ?, ?)", rows)
+    before = conn.total_changes
+    conn.execute(upsert_grades_from_staging_SQL)
+    changes = conn.total_changes - before
+    conn.execute("DELETE FROM grades_staging")
+    return changes
+
+
+def gen_subject_snames(path="sqlite.db"):
+    conn = create_conn(path)
     if conn is not None:
         subjects = conn.execute("SELECT * FROM subjects").fetchall()
         for sub in subjects:
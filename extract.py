@@ -1,6 +1,6 @@
 import configparser
 from configparser import ConfigParser
-from typing import Dict, Mapping, Tuple
+from typing import Dict, List, Mapping, Optional, Set, Tuple
 from bs4 import BeautifulSoup
 import os
 from types import __dict__
@@ -10,8 +10,15 @@ from threading import Thread
 import sqlite3
 from sqlite3 import Error
 import database
+import metrics
+from archive import Archive
+from grade_store import GradeStore
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
 
-pautas_root = "/home/hobocrow/repos/notas_scrapper/pautas/"
+pautas_root = "./pautas/"
 
 # TinyDB
 db = TinyDB("db.json")
@@ -23,11 +30,18 @@ sqliteDb = sqlite3.connect("sqlite.db")
 
 new_students = set()
 new_courses = set()
-new_grades = set()
+new_grades = GradeStore()
 scores = {}
 
 config = None
 
+phases = ["EF", "EN", "ER", "EEPlus"]
+whitespace = re.compile(r'\s+')
+# Use the streaming PautaParser instead of building a BeautifulSoup tree
+use_fast_parser = True
+# Archive the pautas are read from instead of pautas_root, see open_archive
+pautas_archive: Optional[Archive] = None
+
 
 def course_info_from_path(path: str) -> Tuple[str, str, str]:
     id = re.search("\(\d+\)", path)[0][1:-1]
@@ -36,68 +50,290 @@ def course_info_from_path(path: str) -> Tuple[str, str, str]:
     return (id, name, year)
 
 
-def parse_table_row(tr: BeautifulSoup) -> Tuple[str, int, int, str]:
-    name, num, _, result = [t.text.strip() for t in tr.find_all("td")]
-    pattern = re.compile('\s+')
-    name = pattern.sub(" ", name)
+def parse_row_cells(cells: List[str]) -> Tuple[str, int, int, str]:
+    name, num, _, result = [c.strip() for c in cells]
+    name = whitespace.sub(" ", name)
     name = name.replace("\t", "").replace("\n", "")
 
     grade = 0
     note = None
     if result.isnumeric():
-        grade = eval(result)
+        grade = int(result)
     else:
         note = result
 
     return (name, num, grade, note)
 
 
-def extract(path: str):
-    course_id, course_name, year = course_info_from_path(path)
-    print(f"Extracting {course_name}")
+def parse_table_row(tr: BeautifulSoup) -> Tuple[str, int, int, str]:
+    return parse_row_cells([t.text for t in tr.find_all("td")])
 
-    new_courses.add((course_id, course_name))
 
-    with open(path) as f:
-        page = BeautifulSoup(f.read(), 'html.parser')
-    for phase in ["EF", "EN", "ER", "EEPlus"]:
-        print(f"\tPhase: {phase}")
+class PautaParser(HTMLParser):
+    '''
+    Streaming pauta parser. Instead of building the whole page tree it only
+    follows div_<phase> > table > table > tbody and keeps the text of the row
+    cells, the same path extract_rows_soup walks with BeautifulSoup.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.rows: Dict[str, List[List[str]]] = {}
+        self.phase = None
+        self.phase_tag = None
+        self.phase_depth = 0
+        self.table_depth = 0
+        self.in_tbody = False
+        self.row = None
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.phase is None:
+            for key, value in attrs:
+                if key == "id" and value and value.startswith("div_") \
+                        and value[4:] in phases and value[4:] not in self.rows:
+                    self.phase = value[4:]
+                    self.phase_tag = tag
+                    self.phase_depth = 1
+                    self.table_depth = 0
+                    self.rows[self.phase] = None
+            return
+
+        if tag == self.phase_tag:
+            self.phase_depth += 1
+        if self.in_tbody:
+            if tag == "tr":
+                self.row = []
+            elif tag == "td" and self.row is not None:
+                self.cell = []
+        elif tag == "table" and self.table_depth < 2:
+            self.table_depth += 1
+        elif tag == "tbody" and self.table_depth == 2:
+            self.in_tbody = True
+            self.rows[self.phase] = []
+
+    def handle_endtag(self, tag):
+        if self.phase is None:
+            return
+
+        if self.in_tbody:
+            if tag == "td" and self.cell is not None:
+                self.row.append("".join(self.cell))
+                self.cell = None
+            elif tag == "tr" and self.row is not None:
+                self.rows[self.phase].append(self.row)
+                self.row = None
+            elif tag == "tbody":
+                self.in_tbody = False
+                self.phase = None
+            return
+
+        if tag == "table" and self.table_depth > 0:
+            # one of the tables closed before reaching the tbody
+            self.phase = None
+        elif tag == self.phase_tag:
+            self.phase_depth -= 1
+            if self.phase_depth == 0:
+                self.phase = None
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def extract_rows(html: str) -> Dict[str, List[Tuple[str, int, int, str]]]:
+    '''
+    Returns the (name, num, grade, note) rows of every phase with data.
+    '''
+    parser = PautaParser()
+    parser.feed(html)
+    parser.close()
+    return parsed_rows(parser)
+
+
+def parsed_rows(parser: PautaParser) -> Dict[str, List[Tuple[str, int, int, str]]]:
+    '''extract_rows of a page fed to parser, possibly in chunks.'''
+    return {phase: [parse_row_cells(cells) for cells in rows]
+            for phase, rows in parser.rows.items() if rows is not None}
+
+
+def extract_rows_soup(html: str) -> Dict[str, List[Tuple[str, int, int, str]]]:
+    '''
+    Same as extract_rows, but builds the full BeautifulSoup tree.
+    '''
+    page = BeautifulSoup(html, 'html.parser')
+    rows = {}
+    for phase in phases:
         try:
             tbody = page.find(
                 id="div_"+phase).find("table").find("table").find("tbody")
             trs = tbody.find_all("tr")
         except AttributeError:
-            print(f"No valid data in {phase}, skiping")
             continue
+        rows[phase] = [parse_table_row(tr) for tr in trs]
+    return rows
+
 
-        for tr in trs:
-            name, num, grade, note = parse_table_row(tr)
+def extract(path: str) -> Tuple[Set, Set, Set]:
+    '''
+    Extracts the students, course and grades of a single pauta.
+    Returns the (students, courses, grades) sets found in the page.
+    '''
+    return extract_timed(path)[0]
 
-            new_students.add((num, name))
+
+def extract_timed(path: str) -> Tuple[Tuple[Set, Set, Set], float]:
+    '''extract and the ms its parsing took (not the read or the sets).'''
+    course_id, course_name, year = course_info_from_path(path)
+    print(f"Extracting {course_name}")
+
+    html = read_pauta(path)
+    start = time.perf_counter()
+    rows = extract_rows(html) if use_fast_parser else extract_rows_soup(html)
+    ms = (time.perf_counter() - start) * 1000
+    for phase in phases:
+        print(f"\tPhase: {phase}")
+        if phase not in rows:
+            print(f"No valid data in {phase}, skiping")
+    return rows_to_sets(rows, course_id, course_name, year), ms
+
+
+def rows_to_sets(rows: Dict[str, List[Tuple[str, int, int, str]]],
+                 course_id: str, course_name: str, year: str) -> Tuple[Set, Set, Set]:
+    '''
+    The (students, courses, grades) sets of the rows of one pauta.
+    '''
+    students = set()
+    courses = {(course_id, course_name)}
+    grades = set()
+    for phase in phases:
+        if phase not in rows:
+            continue
+
+        for name, num, grade, note in rows[phase]:
+            students.add((num, name))
             # value,note,phase,subject_id,student_num
-            new_grades.add((grade, note, phase, course_id, num, year))
+            grades.add((grade, note, phase, course_id, num, year))
+
+    return students, courses, grades
+
+
+def open_archive(root: str):
+    global pautas_archive
+    pautas_archive = Archive(root)
+
+
+def read_pauta(path: str) -> str:
+    if pautas_archive is not None:
+        return pautas_archive.get(path).decode()
+    with open(path) as f:
+        return f.read()
+
+
+def list_pautas(root: str = None) -> List[str]:
+    root = root or pautas_root
+    files = []
+    for fd in sorted(os.listdir(root)):
+        if not os.path.isdir(os.path.join(root, fd)):
+            continue
+        for file in sorted(os.listdir(os.path.join(root, fd))):
+            if file.endswith(".html"):
+                files.append(os.path.join(root, fd, file))
+    return files
+
+
+def start_extraction(jobs: int = 1, files: List[str] = None, archive_root: str = None):
+    '''
+    Extracts every pauta (or only the given files) into the new_students
+    and new_courses sets and the new_grades store. With jobs > 1 the pages
+    are parsed by a pool of processes, the results are merged in file
+    order. With an archive_root the pautas are read from that archive,
+    files are then archive paths.
+    '''
+    if archive_root is not None:
+        open_archive(archive_root)
+    if files is None:
+        files = pautas_archive.paths() if pautas_archive is not None else list_pautas()
+
+    if jobs > 1:
+        initializer, initargs = (open_archive, (archive_root,)) if archive_root else (None, ())
+        with ProcessPoolExecutor(max_workers=jobs, initializer=initializer,
+                                 initargs=initargs) as executor:
+            results = list(executor.map(extract_timed, files, chunksize=2))
+    else:
+        results = [extract_timed(file) for file in files]
+
+    # the times are recorded here, the registries of the pool processes are lost
+    for (students, courses, grades), ms in results:
+        metrics.registry.observe("parse_ms", ms, page="pauta")
+        new_students.update(students)
+        new_courses.update(courses)
+        new_grades.update(grades)
 
 
-def start_extraction():
-    year_folders = os.listdir(pautas_root)
-    for fd in year_folders:
-        files = os.listdir(pautas_root+fd)
-        for file in files:
-            extract(pautas_root+fd+"/"+file)
+def to_table_rows() -> Tuple[List, List, List]:
+    '''
+    Converts the extracted sets to sorted rows for the students, subjects and
+    grades tables, ids as integers.
+    '''
+    return table_rows(new_students, new_courses, new_grades)
+
+
+def table_rows(students: Set, courses: Set, grades: Set) -> Tuple[List, List, List]:
+    students = sorted((int(num), name) for num, name in students)
+    courses = sorted((int(id), name) for id, name in courses)
+    grades = sorted(((grade, note, phase, int(course_id), int(num), year)
+                     for grade, note, phase, course_id, num, year in grades),
+                    key=lambda g: (g[5], g[3], g[2], g[4]))
+    return students, courses, grades
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract grades from pautas")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of extraction processes")
+    parser.add_argument("--changed", action="store_true",
+                        help="only extract the pautas listed in the scrapper changed file")
+    parser.add_argument("--soup", action="store_true",
+                        help="parse the pautas with BeautifulSoup instead of the streaming parser")
+    parser.add_argument("--db", default="sqlite.db",
+                        help="SQLite database to load the grades into")
+    parser.add_argument("--no-load", action="store_true",
+                        help="only extract, do not write to the database")
+    parser.add_argument("--journal-mode", default="WAL",
+                        help="journal_mode pragma used during the load")
+    parser.add_argument("--synchronous", default="NORMAL",
+                        help="synchronous pragma used during the load")
+    parser.add_argument("--metrics",
+                        help="write the metrics here at the end (.prom for Prometheus text, else JSON lines)")
+    parser.add_argument("--archive",
+                        help="read the pautas from this archive (see archive.py) instead of ./pautas")
+    args = parser.parse_args()
+    use_fast_parser = not args.soup
+
+    files = None
+    if args.changed:
+        import scrap
+        with open(scrap.changed_file_name) as f:
+            files = [line.strip() for line in f if line.strip()]
 
-    # start_extraction()
+    start = time.perf_counter()
+    start_extraction(args.jobs, files, args.archive)
+    print(f"Extracted {len(new_grades)} grades of {len(new_students)} students "
+          f"in {len(new_courses)} courses ({time.perf_counter() - start:.2f} s)")
 
-    # conn = database.create_conn()
-    # if conn is not None:
-    #     conn.executemany(
-    #         "INSERT INTO students VALUES(?,?)", new_students)
-    #     conn.executemany(
-    #         "INSERT INTO subjects VALUES(?,?)", new_courses)
-    #     conn.executemany(
-    #         "INSERT INTO grades VALUES(?,?,?,?,?,?)", new_grades)
+    if not args.no_load:
+        conn = database.create_conn(args.db)
+        if conn is None:
+            exit()
+        start = time.perf_counter()
+        counts = database.bulk_load(conn, *to_table_rows(),
+                                    journal_mode=args.journal_mode,
+                                    synchronous=args.synchronous)
+        conn.close()
+        print("Upserted {} students, {} subjects and {} grades ({:.2f} s)".format(
+            *counts, time.perf_counter() - start))
 
-    #     conn.commit()
-    #     conn.close()
+    print(metrics.summary())
+    if args.metrics:
+        metrics.write(args.metrics)
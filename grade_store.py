@@ -0,0 +1,105 @@
+'''
+Compact in memory store of the extracted grades. Holds the same
+(grade, note, phase, course_id, num, year) rows as the set of tuples
+extract.py used to collect, with the same deduplication, but as columns:
+student numbers, subject ids, years and notes are interned once and every
+row is six small integers in array columns (grade in an array('b')).
+'''
+from array import array
+from enum import IntEnum
+from typing import Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+
+T = TypeVar("T")
+
+
+class Phase(IntEnum):
+    EF = 0
+    EN = 1
+    ER = 2
+    EEPlus = 3
+
+
+class Interner(Generic[T]):
+    '''Maps every distinct value to a small integer, in insertion order.'''
+
+    def __init__(self):
+        self.index: Dict[T, int] = {}
+        self.values: List[T] = []
+
+    def get(self, value: T) -> int:
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class GradeStore():
+    columns = ("grade", "note", "phase", "subject", "student", "year")
+
+    def __init__(self, rows: Iterable[Tuple] = ()):
+        self.subjects: Interner[str] = Interner()
+        self.students: Interner[str] = Interner()
+        self.years: Interner[str] = Interner()
+        self.notes: Interner[Optional[str]] = Interner()
+        self.notes.get(None)
+        self.grade = array("b")
+        self.note = array("H")
+        self.phase = array("B")
+        self.subject = array("H")
+        self.student = array("I")
+        self.year = array("B")
+        # rows from unique_rows on are not deduplicated yet
+        self.unique_rows = 0
+        self.update(rows)
+
+    def add(self, row: Tuple):
+        grade, note, phase, course_id, num, year = row
+        self.grade.append(grade)
+        self.note.append(self.notes.get(note))
+        self.phase.append(Phase[phase])
+        self.subject.append(self.subjects.get(course_id))
+        self.student.append(self.students.get(num))
+        self.year.append(self.years.get(year))
+
+    def update(self, rows: Iterable[Tuple]):
+        for row in rows:
+            self.add(row)
+        # drop duplicates once the pending rows outnumber the unique ones,
+        # so memory stays proportional to the distinct rows
+        if len(self.grade) > 2 * max(self.unique_rows, 1024):
+            self.deduplicate()
+
+    def deduplicate(self):
+        if self.unique_rows == len(self.grade):
+            return
+        table = np.unique(np.column_stack(
+            [np.asarray(getattr(self, name), dtype=np.int64) for name in self.columns]), axis=0)
+        for i, name in enumerate(self.columns):
+            column = array(getattr(self, name).typecode)
+            column.frombytes(table[:, i].astype(np.dtype(column.typecode)).tobytes())
+            setattr(self, name, column)
+        self.unique_rows = len(self.grade)
+
+    def __len__(self) -> int:
+        self.deduplicate()
+        return len(self.grade)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        '''The rows as extract.py tuples, in no particular order.'''
+        self.deduplicate()
+        notes, subjects, students, years = (self.notes.values, self.subjects.values,
+                                            self.students.values, self.years.values)
+        phases = [p.name for p in Phase]
+        for grade, note, phase, subject, student, year in zip(
+                self.grade, self.note, self.phase, self.subject, self.student, self.year):
+            yield (grade, notes[note], phases[phase], subjects[subject], students[student], years[year])
+
+    def nbytes(self) -> int:
+        '''Bytes of the columns (not counting the interned values).'''
+        return sum(getattr(self, name).itemsize * len(self.grade) for name in self.columns)
@@ -0,0 +1,174 @@
+'''
+Persistent queue of the scrape jobs, so an interrupted scrape (crash,
+expired session, server errors) resumes where it stopped instead of
+starting over from the login.
+
+Every page to fetch is a row of the jobs table, keyed by (year, course):
+
+    year = ""            the pautas page listing the years
+    course = ""          the page of a year, listing its courses
+    otherwise            the pauta of course in year
+
+The state of a job is committed as soon as its page is done, or failed.
+A failed job is retried after an exponential backoff with full jitter,
+until it fails max_attempts times.
+'''
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+jobs_file_name = "./pautas/jobs.db"
+
+create_jobs_SQL = """
+CREATE TABLE IF NOT EXISTS jobs (
+    year TEXT,
+    course TEXT,
+    url TEXT,
+    state TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt REAL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY(year, course)
+);
+"""
+
+
+@dataclass
+class Job():
+    year: str
+    course: str
+    url: str
+    state: str = "pending"
+    attempts: int = 0
+    next_attempt: float = 0
+
+
+def retry_delay(attempts: int, base: float = 1, cap: float = 300) -> float:
+    '''
+    Seconds to wait before the next attempt of a job that failed attempts
+    times: uniform between 0 and base * 2^attempts, at most cap.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempts))
+
+
+class JobQueue():
+    '''
+    The jobs table of a SQLite database. The connection is shared by the
+    worker threads, behind a lock.
+    '''
+
+    def __init__(self, path: str = jobs_file_name, max_attempts: int = 6,
+                 base_delay: float = 1, max_delay: float = 300):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(create_jobs_SQL)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, year: str, course: str, url: str):
+        '''Queues a page, unless it is already queued (or done).'''
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO jobs(year, course, url) VALUES(?, ?, ?)",
+                              (year, course, url))
+
+    def due(self, year: str = None) -> List[Job]:
+        '''
+        The pending jobs (of year if given) whose next attempt is due: the
+        pautas page first, then year by year, the year page before its
+        pautas.
+        '''
+        sql = ("SELECT year, course, url, state, attempts, next_attempt FROM jobs "
+               "WHERE state = 'pending' AND next_attempt <= ?")
+        params = [time.time()]
+        if year is not None:
+            sql += " AND year = ?"
+            params.append(year)
+        with self.lock:
+            rows = self.conn.execute(
+                sql + " ORDER BY year != '', year DESC, course != '', course", params).fetchall()
+        return [Job(*row) for row in rows]
+
+    def get(self, year: str, course: str) -> Optional[Job]:
+        with self.lock:
+            row = self.conn.execute("SELECT year, course, url, state, attempts, next_attempt "
+                                    "FROM jobs WHERE year = ? AND course = ?",
+                                    (year, course)).fetchone()
+        return Job(*row) if row is not None else None
+
+    def next_due_in(self) -> Optional[float]:
+        '''Seconds until a pending job is due, None if none is pending.'''
+        with self.lock:
+            next_attempt, = self.conn.execute(
+                "SELECT MIN(next_attempt) FROM jobs WHERE state = 'pending'").fetchone()
+        if next_attempt is None:
+            return None
+        return max(0.0, next_attempt - time.time())
+
+    def done(self, job: Job):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET state = 'done', error = NULL "
+                              "WHERE year = ? AND course = ?", (job.year, job.course))
+        job.state = "done"
+
+    def fail(self, job: Job, error: str):
+        '''
+        Records a failed attempt. The job is retried after a backoff, or
+        given up on (state failed) after max_attempts.
+        '''
+        job.attempts += 1
+        job.state = "failed" if job.attempts >= self.max_attempts else "pending"
+        job.next_attempt = time.time() + retry_delay(job.attempts, self.base_delay, self.max_delay)
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET state = ?, attempts = ?, next_attempt = ?, error = ? "
+                              "WHERE year = ? AND course = ?",
+                              (job.state, job.attempts, job.next_attempt, error,
+                               job.year, job.course))
+
+    def defer(self, job: Job, until: float):
+        '''Moves the next attempt of a job to until, without counting one.'''
+        job.next_attempt = until
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET next_attempt = ? WHERE year = ? AND course = ?",
+                              (until, job.year, job.course))
+
+    def give_up(self, job: Job, error: str):
+        '''Marks a job failed right away, e.g. when the page it needs failed.'''
+        job.state = "failed"
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET state = 'failed', error = ? "
+                              "WHERE year = ? AND course = ?", (error, job.year, job.course))
+
+    def retry_failed(self) -> int:
+        '''Makes the failed jobs pending again, with no attempts. Returns how many.'''
+        with self.lock, self.conn:
+            return self.conn.execute("UPDATE jobs SET state = 'pending', attempts = 0, "
+                                     "next_attempt = 0 WHERE state = 'failed'").rowcount
+
+    def counts(self) -> Dict[str, int]:
+        '''Number of jobs by state.'''
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def failed(self) -> List[Job]:
+        with self.lock:
+            rows = self.conn.execute("SELECT year, course, url, state, attempts, next_attempt "
+                                     "FROM jobs WHERE state = 'failed' "
+                                     "ORDER BY year, course").fetchall()
+        return [Job(*row) for row in rows]
+
+    def finished(self) -> bool:
+        '''True if there is nothing to resume: no jobs, or none pending.'''
+        return not self.counts().get("pending")
+
+    def reset(self):
+        '''Forgets every job, to start a new scrape.'''
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs")
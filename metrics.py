@@ -0,0 +1,212 @@
+'''
+Metrics of the bot and the scrapper: latency histograms per endpoint,
+bytes transferred, parse time per page and counters (requests by status,
+retries, registration attempt outcomes). Network time (http_request_ms) and
+parse time (parse_ms) are separate metrics, so where an attempt spends its
+milliseconds can be read from the two.
+
+Everything goes to the process wide registry. Export it with
+write_prometheus (Prometheus text format, e.g. for the node exporter
+textfile collector) or write_jsonl. If trace_file_name is set every HTTP
+hop is also appended to that JSON lines file as it happens.
+'''
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+latency_buckets_ms = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+trace_file_name: Optional[str] = None
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram():
+    def __init__(self, buckets: Tuple[float, ...] = latency_buckets_ms):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        '''Upper bound of the bucket holding the q quantile.'''
+        if not self.count:
+            return None
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= q * self.count:
+                return bound
+        return float("inf")
+
+
+class Registry():
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        '''Observes the ms spent inside the with block.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def records(self) -> List[Dict]:
+        with self.lock:
+            records = [{"metric": name, "type": "counter", "labels": dict(labels), "value": value}
+                       for (name, labels), value in sorted(self.counters.items())]
+            for (name, labels), h in sorted(self.histograms.items()):
+                records.append({"metric": name, "type": "histogram", "labels": dict(labels),
+                                "count": h.count, "sum": h.sum,
+                                "buckets": dict(zip(map(str, h.buckets), h.counts))})
+        return records
+
+
+registry = Registry()
+
+
+def endpoint(url: str) -> str:
+    '''
+    Short name of an inforestudante url: "login" or the last path segment
+    ("init.do", "listaInscricoes.do", "inscrever.do", ...).
+    '''
+    path = urlsplit(url).path
+    if path.endswith("/security/login.do"):
+        return "login"
+    return path.rstrip("/").rsplit("/", 1)[-1] or "/"
+
+
+def record_http(endpoint: str, method: str, status: int, latency: float,
+                received: int, sent: int = 0):
+    '''Records one HTTP hop. latency is in ms, sizes in bytes.'''
+    registry.observe("http_request_ms", latency, endpoint=endpoint, method=method)
+    registry.inc("http_requests_total", endpoint=endpoint, method=method, status=str(status))
+    registry.inc("http_received_bytes_total", received, endpoint=endpoint)
+    registry.inc("http_sent_bytes_total", sent, endpoint=endpoint)
+    if trace_file_name is not None:
+        trace({"event": "http", "endpoint": endpoint, "method": method, "status": status,
+               "ms": round(latency, 3), "received": received, "sent": sent})
+
+
+trace_lock = threading.Lock()
+
+
+def trace(record: Dict):
+    record = {"time": time.time(), "thread": threading.current_thread().name, **record}
+    with trace_lock:
+        with open(trace_file_name, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def response_hook(r, *args, **kwargs):
+    '''
+    requests response hook. The time is until the headers arrived plus the
+    body download, except for streamed responses whose body is left to
+    the caller; their size comes from Content-Length. The wait for the
+    rate limiter is not counted, it is in ratelimit_wait_ms.
+    '''
+    start = time.perf_counter()
+    if kwargs.get("stream"):
+        received = int(r.headers.get("Content-Length", 0))
+    else:
+        received = len(r.content)
+    latency = r.elapsed.total_seconds() * 1000 + (time.perf_counter() - start) * 1000 \
+        - getattr(r, "ratelimit_wait_ms", 0)
+    body = r.request.body or b""
+    record_http(endpoint(r.url), r.request.method, r.status_code, latency,
+                received, len(body))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: Dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+def prometheus_text() -> str:
+    lines = []
+    typed = set()
+    for record in registry.records():
+        name = record["metric"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} {record['type']}")
+            typed.add(name)
+        labels = record["labels"]
+        if record["type"] == "counter":
+            lines.append(f"{name}{format_labels(labels)} {record['value']}")
+            continue
+        for le, count in record["buckets"].items():
+            lines.append(f"{name}_bucket{format_labels(labels, le=le)} {count}")
+        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {record['count']}")
+        lines.append(f"{name}_sum{format_labels(labels)} {record['sum']}")
+        lines.append(f"{name}_count{format_labels(labels)} {record['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(file_name: str):
+    with open(file_name, "w") as f:
+        f.write(prometheus_text())
+
+
+def write_jsonl(file_name: str):
+    now = time.time()
+    with open(file_name, "a") as f:
+        for record in registry.records():
+            f.write(json.dumps({"time": now, **record}) + "\n")
+
+
+def write(file_name: str):
+    '''Prometheus text for .prom files, JSON lines otherwise.'''
+    if file_name.endswith(".prom"):
+        write_prometheus(file_name)
+    else:
+        write_jsonl(file_name)
+
+
+def summary() -> str:
+    '''One line per latency histogram: count, mean and approximate p95.'''
+    lines = []
+    for record in registry.records():
+        if record["type"] != "histogram" or not record["count"]:
+            continue
+        key = (record["metric"], tuple(sorted(record["labels"].items())))
+        p95 = registry.histograms[key].quantile(0.95)
+        labels = " ".join(f"{k}={v}" for k, v in record["labels"].items())
+        lines.append(f"{record['metric']} {labels}: {record['count']} in "
+                     f"{record['sum']:.0f} ms, mean {record['sum'] / record['count']:.1f} ms, "
+                     f"p95 <= {p95} ms")
+    return "\n".join(lines)
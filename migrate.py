@@ -0,0 +1,133 @@
+'''
+One-shot migration of the TinyDB store (db.json) into the SQLite schema.
+
+The TinyDB course ids ("01000010") become the integer subjects.id and the
+scores of each grade document ({year: {phase: value}}) are exploded into one
+grades row per (year, phase). After the load the row counts and the per
+student (count, sum) of the grades are checked against both stores.
+'''
+import argparse
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from tinydb import TinyDB
+
+import database
+from extract import parse_row_cells
+
+
+class Migration():
+    def __init__(self, db: TinyDB):
+        self.db = db
+        # (phase, year, subject_id, student_num) -> val, filled while streaming
+        self.grade_keys: Dict[Tuple, int] = {}
+        self.student_nums = set()
+        self.subject_ids = set()
+
+    def students(self) -> Iterable[Tuple[int, str]]:
+        for student in self.db.table("students"):
+            num = int(student["num"])
+            self.student_nums.add(num)
+            yield (num, student["name"])
+
+    def subjects(self) -> Iterable[Tuple[int, str]]:
+        for course in self.db.table("courses"):
+            id = int(course["id"])
+            self.subject_ids.add(id)
+            yield (id, course["name"])
+
+    def grades(self) -> Iterable[Tuple]:
+        for grade in self.db.table("grades"):
+            subject_id = int(grade["course_id"])
+            num = int(grade["num"])
+            for year, scores in grade["scores"].items():
+                for phase, value in scores.items():
+                    # same value/note split as the pautas extraction
+                    _, _, val, note = parse_row_cells(["", "", "", value])
+                    self.grade_keys[(phase, year, subject_id, num)] = val
+                    yield (val, note, phase, subject_id, num, year)
+
+    def run(self, conn) -> Tuple[int, int, int]:
+        return database.bulk_load(conn, self.students(), self.subjects(),
+                                  self.grades(), batch_size=10000)
+
+    def check(self, conn) -> List[str]:
+        '''
+        Compares the migrated data with what is in SQLite.
+        Returns a list of the problems found, empty if everything matches.
+        '''
+        errors = []
+
+        def count_present(table: str, column: str, values) -> int:
+            conn.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS check_{table}(v PRIMARY KEY)")
+            conn.execute(f"DELETE FROM check_{table}")
+            conn.executemany(
+                f"INSERT INTO check_{table} VALUES(?)", ((v,) for v in values))
+            return conn.execute(
+                f"SELECT count(*) FROM {table} JOIN check_{table} ON {column} = v"
+            ).fetchone()[0]
+
+        for table, column, values in (("students", "num", self.student_nums),
+                                      ("subjects", "id", self.subject_ids)):
+            present = count_present(table, column, values)
+            if present != len(values):
+                errors.append(
+                    f"{table}: {len(values)} in TinyDB, {present} in SQLite")
+
+        conn.execute("""CREATE TEMP TABLE IF NOT EXISTS check_grades(
+            phase, year, subject_id, student_num,
+            PRIMARY KEY(phase, year, subject_id, student_num))""")
+        conn.execute("DELETE FROM check_grades")
+        conn.executemany("INSERT INTO check_grades VALUES(?, ?, ?, ?)",
+                         self.grade_keys.keys())
+        sqlite_aggregates = {
+            num: (n, total) for num, n, total in conn.execute("""
+            SELECT g.student_num, count(*), sum(g.val) FROM grades AS g
+            JOIN check_grades USING(phase, year, subject_id, student_num)
+            GROUP BY g.student_num""")}
+
+        tinydb_aggregates: Dict[int, Tuple[int, int]] = {}
+        for (_, _, _, num), val in self.grade_keys.items():
+            n, total = tinydb_aggregates.get(num, (0, 0))
+            tinydb_aggregates[num] = (n + 1, total + val)
+
+        present = sum(n for n, _ in sqlite_aggregates.values())
+        if present != len(self.grade_keys):
+            errors.append(
+                f"grades: {len(self.grade_keys)} in TinyDB, {present} in SQLite")
+        for num, aggregate in tinydb_aggregates.items():
+            if sqlite_aggregates.get(num) != aggregate:
+                errors.append(f"student {num}: (count, sum) {aggregate} in TinyDB, "
+                              f"{sqlite_aggregates.get(num)} in SQLite")
+        conn.commit()
+        return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate db.json (TinyDB) into the SQLite database")
+    parser.add_argument("--json", default="db.json")
+    parser.add_argument("--db", default="sqlite.db")
+    args = parser.parse_args()
+
+    conn = database.create_conn(args.db)
+    if conn is None:
+        exit(1)
+
+    start = time.perf_counter()
+    migration = Migration(TinyDB(args.json))
+    counts = migration.run(conn)
+    print("Upserted {} students, {} subjects and {} grades ({:.2f} s)".format(
+        *counts, time.perf_counter() - start))
+
+    errors = migration.check(conn)
+    conn.close()
+    for error in errors:
+        print(error)
+    if errors:
+        print(f"Integrity check failed: {len(errors)} problems")
+        exit(1)
+    print(f"Integrity check passed: {len(migration.student_nums)} students, "
+          f"{len(migration.subject_ids)} subjects, "
+          f"{len(migration.grade_keys)} grades")
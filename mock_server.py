@@ -0,0 +1,351 @@
+'''
+Local stand-in for inforestudante, used to try the bot and the scrapper
+without touching the real server. It serves the login, the inscturmas
+pages (subject listing, subject form and the inscrever.do?method=submeter
+POST with the same redirects as the real one) using the saved test.html as
+the subject page, and the pautas year pages and pautas from a pautas/ tree
+(one directory per year, as written by scrap.py).
+
+Point the bot at it with bot.set_base_url(server.url).
+'''
+import argparse
+import html
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+from zoneinfo import ZoneInfo
+
+subject_page_file_name = "test.html"
+pautas_root = "./pautas/"
+server_timezone = ZoneInfo("Europe/Lisbon")
+
+login_page = '''<html><body>
+<form id="loginFormBean" method="post" action="/nonio/security/login.do?method=submeter">
+<input type="text" name="username"/><input type="password" name="password"/>
+</form></body></html>'''
+
+dashboard_page = '''<html><body>
+<a href="../pautas/init.do"><span class="menu_30">Pautas</span></a>
+</body></html>'''
+
+login_error_page = '''<html><body>
+<div id="div_erros_preenchimento_formulario"><div><ul><li>Credenciais erradas</li></ul></div></div>
+</body></html>'''
+
+pautas_year_page = '''<html><body>
+<form id="pesquisaPautasFormBean" method="post" action="/nonio/pautas/pesquisaPautas.do">
+<table><tr id="linhaAnoLectivoMinhasUc">
+<td>Ano Letivo</td>
+<td>
+<select name="anoLectivoMinhasUCSeleccionado" onchange="submeterForm('pesquisaPautas.do?method=mudarAno')">{options}</select></td>
+</tr></table>
+<table class="displaytable"><tbody>{rows}</tbody></table>
+</form></body></html>'''
+
+insc_turmas_init_page = '''<html><body>
+<div id="link_0"><a href="listaInscricoes.do?args=5189681149284684">LEI</a></div>
+</body></html>'''
+
+
+class MockInforestudante():
+    '''
+    Server state. Registrations open at open_at (epoch seconds, server
+    clock), every response is delayed by latency seconds and the server clock
+    is clock_skew seconds ahead of the local one. A fraction error_rate of
+    the pautas requests is answered with a 503, as are all of them while
+    more than capacity requests are being served (0 for no limit).
+    '''
+
+    def __init__(self, open_at: float = 0, latency: float = 0,
+                 subject_page: str = None, turma_seats: Dict[str, int] = None,
+                 clock_skew: float = 0, pautas: str = None, error_rate: float = 0,
+                 capacity: int = 0):
+        if subject_page is None:
+            with open(subject_page_file_name) as f:
+                subject_page = f.read()
+        self.subject_page = subject_page
+        self.subject_name = re.search(
+            r'class="subtitle">\s*(.+?) - \d+\s*<', subject_page).group(1)
+        self.open_at = open_at
+        self.latency = latency
+        self.clock_skew = clock_skew
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.in_flight = 0
+        # input value -> turma and turma -> free seats, from the page rows
+        self.turmas: Dict[str, str] = {}
+        self.seats: Dict[str, int] = {}
+        for row in re.findall(r"<tr[^>]*>(.*?)</tr>", subject_page, re.S):
+            cells = re.findall(r"<td[^>]*>([^<]*)</td>", row)
+            if len(cells) < 4 or not cells[3].strip().isnumeric():
+                continue
+            turma = cells[0].strip()
+            self.seats[turma] = int(cells[3])
+            for value in re.findall(r'value="(\d+)"', row):
+                self.turmas[value] = turma
+        self.seats.update(turma_seats or {})
+        # session cookie -> logged in
+        self.sessions: Dict[str, bool] = {}
+        # session cookie -> turma the student is in
+        self.registered: Dict[str, str] = {}
+        self.requests: List[Tuple[str, str]] = []
+        # year (2017/2018) -> course id -> pauta file
+        self.pautas: Dict[str, Dict[str, str]] = {}
+        # session cookie -> year selected in the pautas page, the most
+        # recent one by default; the pautas requested for another year
+        self.selected_years: Dict[str, str] = {}
+        self.wrong_year: List[str] = []
+        if pautas is not None:
+            self.load_pautas(pautas)
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, port: int = 0) -> "MockInforestudante":
+        state = self
+
+        class Handler(MockHandler):
+            mock = state
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def now(self) -> float:
+        return time.time() + self.clock_skew
+
+    def is_open(self) -> bool:
+        return self.now() >= self.open_at
+
+    def format_time(self, t: float) -> str:
+        return datetime.fromtimestamp(t, server_timezone).strftime("%d-%m-%Y %H:%M")
+
+    def load_pautas(self, root: str):
+        for year in sorted(os.listdir(root), reverse=True):
+            path = os.path.abspath(os.path.join(root, year))
+            if not os.path.isdir(path):
+                continue
+            files = self.pautas[year.replace("-", "/")] = {}
+            for file in sorted(os.listdir(path)):
+                match = re.search(r"\((\d+)\)\.html$", file)
+                if match:
+                    files[match.group(1)] = os.path.join(path, file)
+
+    def pautas_page(self, year: str = None) -> str:
+        '''Year page listing the pautas of year, the most recent by default.'''
+        years = list(self.pautas)
+        year = year if year in self.pautas else years[0]
+        selected = ' selected="selected"'
+        options = "".join(
+            f'<option value="{y}"{selected if y == year else ""}>{y}</option>' for y in years)
+        rows = "".join(
+            f'<tr>\n<td>{html.escape(os.path.basename(file)[:-len(".html")])}</td>\n'
+            f'<td><a class="botaodetalhes" href="detalhe.do?ano={year}&amp;uc={id}">Detalhes</a></td>\n</tr>'
+            for id, file in self.pautas[year].items())
+        return pautas_year_page.format(options=options, rows=rows)
+
+    def listing_page(self, session: str) -> str:
+        turma = self.registered.get(session, "T1")
+        return f'''<html><body>
+<form id="listaInscricoesFormBean" method="post" action="/nonio/inscturmas/listaInscricoes.do">
+<table class="displaytable"><thead><tr><th>Código</th></tr></thead><tbody>
+<tr>
+<td>02038558</td>
+<td class="contentLeft"><span>{self.subject_name}&nbsp;*</span></td>
+<td>2.º Semestre</td>
+<td>{turma}</td>
+<td>{self.format_time(self.open_at)}</td>
+<td>{self.format_time(self.open_at + 36000)}</td>
+<td><a href="inscrever.do?args=1">Inscrições</a></td>
+</tr></tbody></table></form></body></html>'''
+
+    def form_page(self) -> str:
+        page = self.subject_page
+        for turma, seats in self.seats.items():
+            page = re.sub(
+                rf'(>{re.escape(turma)}</td>(?:\s*<td[^>]*>[^<]*</td>){{2}}\s*<td[^>]*>)\d+(</td>)',
+                rf'\g<1>{seats}\g<2>', page)
+        return page
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock: MockInforestudante = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def date_time_string(self, timestamp=None):
+        return super().date_time_string(self.mock.now() if timestamp is None else timestamp)
+
+    def session_id(self) -> str:
+        cookie = self.headers.get("Cookie", "")
+        match = re.search(r"JSESSIONID=([^;\s]+)", cookie)
+        return match.group(1) if match else None
+
+    def reply(self, body: str = "", status: int = 200, headers: Dict = None):
+        time.sleep(self.mock.latency)
+        data = body if isinstance(body, bytes) else body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html;charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def redirect(self, location: str):
+        self.reply(status=302, headers={"Location": location})
+
+    def read_form(self) -> Dict[str, List[str]]:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return parse_qs(body.decode())
+        # urllib3 (scrap.py) posts its fields as multipart
+        message = BytesParser(policy=policy.default).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        form = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            form.setdefault(name, []).append(part.get_content())
+        return form
+
+    def do_GET(self):
+        self.serve("GET")
+
+    def do_POST(self):
+        self.serve("POST")
+
+    def do_HEAD(self):
+        self.serve("HEAD")
+
+    def serve(self, method: str):
+        with self.mock.lock:
+            self.mock.in_flight += 1
+        try:
+            self.route(method)
+        finally:
+            with self.mock.lock:
+                self.mock.in_flight -= 1
+
+    def route(self, method: str):
+        path = urlsplit(self.path).path
+        query = urlsplit(self.path).query
+        session = self.session_id()
+        with self.mock.lock:
+            self.mock.requests.append((method, self.path))
+        logged_in = self.mock.sessions.get(session, False)
+
+        if path == "/nonio/security/login.do":
+            if method == "POST":
+                form = self.read_form()
+                if not form.get("password", [""])[0]:
+                    return self.reply(login_error_page)
+                self.mock.sessions[session] = True
+                return self.reply(dashboard_page)
+            session = uuid.uuid4().hex
+            self.mock.sessions[session] = False
+            return self.reply(login_page, headers={
+                "Set-Cookie": f"JSESSIONID={session}; Path=/nonio; HttpOnly"})
+
+        overloaded = 0 < self.mock.capacity < self.mock.in_flight
+        if not logged_in or (path.startswith("/nonio/pautas/")
+                             and (overloaded or random.random() < self.mock.error_rate)):
+            # an unread body would be taken for the next request on the connection
+            if method == "POST":
+                self.read_form()
+            if not logged_in:
+                return self.redirect("/nonio/security/login.do")
+            return self.reply("Service Unavailable", status=503)
+        if path == "/nonio/dashboard/dashboard.do":
+            return self.reply(dashboard_page)
+        if path in ("/nonio/pautas/init.do", "/nonio/pautas/pesquisaPautas.do") and self.mock.pautas:
+            year = self.read_form().get("anoLectivoMinhasUCSeleccionado", [None])[0] \
+                if method == "POST" else None
+            with self.mock.lock:
+                self.mock.selected_years[session] = year if year in self.mock.pautas \
+                    else next(iter(self.mock.pautas))
+            return self.reply(self.mock.pautas_page(year))
+        if path == "/nonio/pautas/detalhe.do":
+            args = parse_qs(query)
+            selected = self.mock.selected_years.get(session, next(iter(self.mock.pautas), None))
+            if args.get("ano", [""])[0] != selected:
+                with self.mock.lock:
+                    self.mock.wrong_year.append(self.path)
+            file = self.mock.pautas.get(args.get("ano", [""])[0], {}).get(args.get("uc", [""])[0])
+            if file is None:
+                return self.reply("Not found", status=404)
+            with open(file, "rb") as f:
+                return self.reply(f.read())
+        if path == "/nonio/inscturmas/init.do":
+            return self.reply(insc_turmas_init_page)
+        if path == "/nonio/inscturmas/listaInscricoes.do":
+            return self.reply(self.mock.listing_page(session))
+        if path == "/nonio/inscturmas/inscrever.do":
+            if method == "POST" and query == "method=submeter":
+                return self.submit(session, self.read_form())
+            return self.reply(self.mock.form_page())
+        return self.reply("Not found", status=404)
+
+    def submit(self, session: str, form: Dict[str, List[str]]):
+        if not self.mock.is_open():
+            # the real server renders the form again on the same url
+            return self.reply(self.mock.form_page())
+        value = form.get("inscrever", [None])[0]
+        turma = self.mock.turmas.get(value)
+        with self.mock.lock:
+            if turma is not None and self.mock.seats.get(turma, 0) > 0:
+                self.mock.seats[turma] -= 1
+                self.mock.registered[session] = turma
+        return self.redirect("/nonio/inscturmas/listaInscricoes.do")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--opens-in", type=float, default=0,
+                        help="seconds until the registrations open")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every response")
+    parser.add_argument("--clock-skew", type=float, default=0,
+                        help="seconds the server clock is ahead of the local one")
+    parser.add_argument("--pautas", default=pautas_root,
+                        help="pautas tree to serve, one directory per year")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of the pautas requests that fail with a 503")
+    parser.add_argument("--capacity", type=int, default=0,
+                        help="requests served at once before the pautas ones fail with a 503")
+    args = parser.parse_args()
+
+    mock = MockInforestudante(time.time() + args.clock_skew + args.opens_in,
+                              args.latency, clock_skew=args.clock_skew,
+                              pautas=args.pautas if os.path.isdir(args.pautas) else None,
+                              error_rate=args.error_rate, capacity=args.capacity)
+    mock.start(args.port)
+    print(f"Serving on {mock.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,127 @@
+'''
+Runs the registration bot for many accounts in one process.
+
+Accounts come from an ini file where every section is an account:
+
+    [alice]
+    username = alice@student.uc.pt
+    password = ...
+    turmas = turmas_alice.json
+
+Every account gets its own sessions, while the parsed pages cache and a
+global request rate limit are shared by all of them. Per account results go
+to the JSON lines results log (bot.results_file_name).
+'''
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import bot
+import metrics
+from ratelimit import AdaptiveLimiter, TokenBucket
+
+
+def run_account(account: bot.Account, limiter: TokenBucket, scheduled: bool,
+                max_sessions: int, max_attempts: int = None,
+                hold: float = None) -> List[bot.Attempt]:
+    start = time.perf_counter()
+    session = bot.new_session(account, limiter)
+    if session is None:
+        bot.log_result({"event": "login-failed", "account": account.name})
+        return []
+    bot.log_result({"event": "login", "account": account.name,
+                    "latency": (time.perf_counter() - start) * 1000})
+
+    success, res = bot.navigate_subjects_page(session)
+    if not success:
+        bot.log_result({"event": "navigation-failed", "account": account.name})
+        return []
+    subjects = bot.extract_subjects(res)
+
+    if scheduled:
+        attempts = bot.do_register_scheduled(
+            subjects, session, max_sessions, account=account, limiter=limiter, hold=hold)
+    else:
+        attempts = bot.do_register_concurrent(
+            subjects, session, max_sessions, max_attempts, account=account, limiter=limiter,
+            hold=hold)
+
+    for a in attempts:
+        bot.log_result({"event": "attempt", "account": account.name,
+                        "subject": a.subject, "turma": a.turma,
+                        "outcome": a.outcome, "latency": a.latency})
+    return attempts
+
+
+def run(accounts: List[bot.Account], rate: float, burst: int, scheduled: bool = False,
+        max_sessions: int = 4, max_attempts: int = None,
+        hold: float = None) -> Dict[str, List[bot.Attempt]]:
+    '''
+    Runs every account at once. All their requests share one adaptive
+    limiter, of at most rate requests per second.
+    '''
+    # max_sessions requests in flight per account
+    limiter = AdaptiveLimiter(rate, burst, max_rate=rate,
+                              max_concurrency=max(1, max_sessions * len(accounts)))
+
+    def run_one(account: bot.Account) -> List[bot.Attempt]:
+        try:
+            return run_account(account, limiter, scheduled, max_sessions, max_attempts, hold)
+        except Exception as e:
+            logging.exception(f"{account.name} failed")
+            bot.log_result({"event": "error", "account": account.name, "error": str(e)})
+            return []
+
+    with ThreadPoolExecutor(max_workers=max(1, len(accounts))) as executor:
+        results = dict(zip((a.name for a in accounts),
+                           executor.map(run_one, accounts)))
+    bot.page_cache.save()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi account turmas bot")
+    parser.add_argument("--accounts", default="accounts.ini",
+                        help="ini file with one section per account")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="maximum requests per second over all accounts")
+    parser.add_argument("--burst", type=int, default=10,
+                        help="requests allowed at once above the rate")
+    parser.add_argument("--scheduled", action="store_true",
+                        help="wait for the enrolment opening of every subject")
+    parser.add_argument("--sessions", type=int, default=4,
+                        help="maximum sessions logging in at once per account")
+    parser.add_argument("--hold", type=float, default=600,
+                        help="seconds to keep polling for a preferred turma once in another one")
+    parser.add_argument("--results", default=bot.results_file_name,
+                        help="JSON lines results log")
+    parser.add_argument("--base-url", default=bot.infor_base_url)
+    parser.add_argument("--metrics",
+                        help="write the metrics here at the end (.prom for Prometheus text, else JSON lines)")
+    parser.add_argument("--trace", help="JSON lines file to append every HTTP request to")
+    args = parser.parse_args()
+    metrics.trace_file_name = args.trace
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(threadName)s %(message)s",
+        level=logging.INFO,
+        datefmt="%H:%M:%S")
+
+    config = bot.load_configs(args.accounts)
+    if config is None:
+        exit()
+    bot.set_base_url(args.base_url)
+    bot.results_file_name = args.results
+
+    accounts = bot.load_accounts(config)
+    logging.info(f"Running {len(accounts)} accounts")
+    results = run(accounts, args.rate, args.burst, args.scheduled, args.sessions,
+                  hold=args.hold)
+    for name, attempts in results.items():
+        outcome = attempts[-1].outcome if attempts else "no attempts"
+        logging.info(f"{name}: {len(attempts)} attempts, {outcome}")
+    logging.info("\n" + metrics.summary())
+    if args.metrics:
+        metrics.write(args.metrics)
@@ -0,0 +1,73 @@
+'''
+Persistent cache of parsed pages. Entries are keyed by URL and hold the hash
+of the response content together with the record the parser extracted from
+it, so parsing an unchanged page again only costs a hash. Records must be
+JSON serializable (lists, dicts, strings).
+'''
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple
+
+import metrics
+
+page_cache_file_name = "page_cache.json"
+
+
+class ParseCache():
+    def __init__(self, file_name: str = page_cache_file_name):
+        self.file_name = file_name
+        self.entries: Dict[str, Tuple[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        if file_name is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.file_name) as f:
+                self.entries = {key: tuple(entry)
+                                for key, entry in json.load(f).items()}
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError as e:
+            logging.info(f"Ignoring invalid page cache {self.file_name}: {e}")
+            self.entries = {}
+
+    def save(self):
+        if self.file_name is None or not self.dirty:
+            return
+        with self.lock:
+            with open(self.file_name, "w") as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+
+    def get(self, kind: str, url: str, content: bytes, parse: Callable[[bytes], Any]) -> Any:
+        '''
+        Returns the record parse(content) would return, from the cache if
+        the content of url did not change since it was last parsed.
+        kind separates the records of different parsers for the same url.
+        The time taken is recorded as the parse_ms metric of page kind.
+        '''
+        start = time.perf_counter()
+        key = f"{kind} {url}"
+        digest = hashlib.sha1(content).hexdigest()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == digest:
+            self.hits += 1
+            metrics.registry.observe("parse_ms", (time.perf_counter() - start) * 1000,
+                                     page=kind, cache="hit")
+            return entry[1]
+
+        self.misses += 1
+        record = parse(content)
+        with self.lock:
+            self.entries[key] = (digest, record)
+            self.dirty = True
+        metrics.registry.observe("parse_ms", (time.perf_counter() - start) * 1000,
+                                 page=kind, cache="miss")
+        return record
@@ -0,0 +1,263 @@
+'''
+Streaming scrape: fetch -> incremental parse -> batched upsert, without the
+pautas/ round trip of scrap.py followed by extract.py.
+
+Every pauta is parsed while it downloads (the body is fed to a PautaParser
+chunk by chunk), its rows go through a bounded queue to a single writer
+thread that upserts them into SQLite in batches. Nothing is written to disk
+except the database, unless an archive directory is given; then every page
+is also kept in that compressed archive (see archive.py).
+
+Memory is bounded by the downloads in flight, the queue size and the batch
+size, whatever the number of years or courses.
+'''
+import argparse
+import codecs
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+from requests.sessions import Session
+
+import database
+import extract
+import metrics
+import scrap
+from archive import Archive
+from client import SessionExpired
+
+
+class BatchWriter():
+    '''
+    Upserts the (students, courses, grades) sets of the pages put in its
+    queue, merged in batches of about batch_size grades. The connection is
+    opened by the writer thread, sqlite3 connections are bound to a thread.
+    '''
+
+    def __init__(self, db: str, batch_size: int = 20000, queue_size: int = 64,
+                 journal_mode: str = "WAL", synchronous: str = "NORMAL"):
+        self.db = db
+        self.batch_size = batch_size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.queue: "queue.Queue[Optional[Tuple[Set, Set, Set]]]" = queue.Queue(maxsize=queue_size)
+        self.counts = [0, 0, 0]
+        self.pages = 0
+        self.batches = 0
+        self.error: Optional[BaseException] = None
+        self.thread = None
+
+    def start(self) -> "BatchWriter":
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def put(self, sets: Tuple[Set, Set, Set]):
+        '''Blocks while the queue is full, so fetching waits for the database.'''
+        if self.error is not None:
+            raise self.error
+        self.queue.put(sets)
+
+    def close(self) -> Tuple[int, int, int]:
+        '''
+        Writes what is left and returns the number of students, subjects and
+        grades written.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return tuple(self.counts)
+
+    def run(self):
+        try:
+            conn = sqlite3.connect(self.db)
+            database.create_table(conn, database.create_table_SQL)
+            with database.load_pragmas(conn, self.journal_mode, self.synchronous):
+                self.consume(conn)
+            conn.close()
+        except BaseException as e:
+            self.error = e
+            # unblock the producers, their next put raises
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def consume(self, conn: sqlite3.Connection):
+        students, courses, grades = set(), set(), set()
+        while True:
+            sets = self.queue.get()
+            if sets is not None:
+                students.update(sets[0])
+                courses.update(sets[1])
+                grades.update(sets[2])
+                self.pages += 1
+            if grades and (len(grades) >= self.batch_size or sets is None):
+                with metrics.registry.timer("db_batch_ms"):
+                    counts = database.upsert_batch(
+                        conn, *extract.table_rows(students, courses, grades))
+                self.counts = [c + n for c, n in zip(self.counts, counts)]
+                self.batches += 1
+                students, courses, grades = set(), set(), set()
+            if sets is None:
+                return
+
+
+def stream_pauta(session: Session, href: str,
+                 archive: Archive = None, archive_path: str = None,
+                 chunk_size: int = 16384) -> Optional[Dict[str, List]]:
+    '''
+    Downloads a pauta feeding it to the streaming parser as it arrives, and
+    stores it in the archive at archive_path if given. Returns its
+    extract_rows, or None if the request failed. Raises SessionExpired if
+    the server sent the login page instead. Network and parse time are
+    recorded separately.
+    '''
+    start = time.perf_counter()
+    r = scrap.client.pauta(session, href, stream=True)
+    parse_time = 0.0
+    try:
+        if scrap.client.expired(r):
+            raise SessionExpired(href)
+        if r.status_code != 200:
+            return None
+        parser = extract.PautaParser()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        chunks = []
+        for chunk in r.raw.stream(chunk_size, decode_content=True):
+            if archive is not None:
+                chunks.append(chunk)
+            parse_start = time.perf_counter()
+            parser.feed(decoder.decode(chunk))
+            parse_time += time.perf_counter() - parse_start
+        parse_start = time.perf_counter()
+        parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+        rows = extract.parsed_rows(parser)
+        parse_time += time.perf_counter() - parse_start
+        if archive is not None:
+            archive.put(archive_path, b"".join(chunks))
+        return rows
+    finally:
+        r.close()
+        # the response hook only timed the headers, the body is read here
+        total = (time.perf_counter() - start) * 1000 - getattr(r, "ratelimit_wait_ms", 0)
+        metrics.registry.observe("http_body_ms", total - parse_time * 1000, endpoint="detalhe.do")
+        if r.status_code == 200:
+            metrics.registry.observe("parse_ms", parse_time * 1000, page="pauta")
+
+
+def run(db: str, archive: Archive = None, workers: int = scrap.workers,
+        batch_size: int = 20000, queue_size: int = 64,
+        journal_mode: str = "WAL", synchronous: str = "NORMAL") -> Tuple[int, int, int]:
+    '''
+    Logs in with the scrapper and streams every pauta of every year into db,
+    a year at a time: the server serves the pautas of the year selected in
+    the session. The pautas that found the session expired are fetched
+    again once logged in and the year selected again. Returns the number
+    of students, subjects and grades written. A database error stops the
+    run.
+    '''
+    pautas_url = scrap.scrap_login()
+    if pautas_url is None:
+        raise Exception("Login failed")
+
+    writer = BatchWriter(db, batch_size, queue_size, journal_mode, synchronous).start()
+    # at most 2 * workers pautas downloading or waiting for a worker
+    in_flight = threading.BoundedSemaphore(2 * workers)
+    failed = []
+
+    def process(year: str, name: str, href: str, expired: List[Tuple[str, str]]):
+        try:
+            year_dir = year.replace("/", "-")
+            sent = time.time()
+            try:
+                rows = stream_pauta(scrap.session, href, archive, f"{year_dir}/{name}.html")
+            except SessionExpired:
+                scrap.relogin(sent)
+                expired.append((name, href))
+                return
+            except requests.RequestException as e:
+                print(f"GET {name} failed: {e}")
+                rows = None
+            if rows is None:
+                print(f"GET {name} failed")
+                failed.append((year, name))
+                return
+            course_id, course_name, year = extract.course_info_from_path(
+                f"{year_dir}/{name}.html")
+            writer.put(extract.rows_to_sets(rows, course_id, course_name, year))
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for year, page in scrap.pautas_years(pautas_url):
+            # a relogin selects it again in the new session
+            _, select_url, _ = scrap.year_info(page)
+            scrap.selected_year, scrap.select_url = year, select_url
+            links = scrap.pauta_links(page)
+            for retry in range(2):
+                expired = []
+                futures = []
+                for name, href in links:
+                    in_flight.acquire()
+                    futures.append(executor.submit(process, year, name, href, expired))
+                # before the next year is selected, raises the writer errors
+                for future in futures:
+                    future.result()
+                if not expired or retry:
+                    break
+                if scrap.selected_year != year:
+                    # the relogin could not select it, the default year is
+                    scrap.client.select_year(scrap.session, select_url, year)
+                    scrap.selected_year = year
+                links = expired
+            failed.extend((year, name) for name, _ in expired)
+
+    counts = writer.close()
+    if archive is not None:
+        archive.save()
+    print(f"{writer.pages} pautas in {writer.batches} batches, {len(failed)} failed")
+    for year, name in failed:
+        print(f"\tfailed: {year} {name}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape the pautas straight into the database")
+    parser.add_argument("--db", default="sqlite.db")
+    parser.add_argument("--archive",
+                        help="also keep the pautas in this compressed archive (see archive.py)")
+    parser.add_argument("--workers", type=int, default=scrap.workers,
+                        help="number of concurrent pauta downloads")
+    parser.add_argument("--max-connections", type=int, default=scrap.max_host_connections,
+                        help="maximum open connections to inforestudante")
+    parser.add_argument("--batch-size", type=int, default=20000,
+                        help="grades per database transaction")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="parsed pautas waiting for the database")
+    parser.add_argument("--base-url", default=scrap.infor_base_url,
+                        help="server to use, e.g. a mock_server.py url")
+    parser.add_argument("--metrics",
+                        help="write the metrics here at the end (.prom for Prometheus text, else JSON lines)")
+    args = parser.parse_args()
+
+    scrap.set_base_url(args.base_url, args.max_connections)
+    scrap.load_credentials()
+
+    start = time.perf_counter()
+    archive = Archive(args.archive) if args.archive else None
+    counts = run(args.db, archive, args.workers, args.batch_size, args.queue_size)
+    if archive is not None:
+        archive.close()
+    print("Upserted {} students, {} subjects and {} grades ({:.2f} s)".format(
+        *counts, time.perf_counter() - start))
+    print(metrics.summary())
+    if args.metrics:
+        metrics.write(args.metrics)
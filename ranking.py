@@ -0,0 +1,122 @@
+'''
+Columnar grades engine. The grades are loaded once into NumPy arrays and the
+best grade of every (student, subject) is kept in a dense matrix, so averages
+and rankings over any subject whitelist are a few array operations instead of
+a Python loop per student.
+
+Same rules as stats.py: the score of a subject is the best grade of any year
+and phase, counted only if it is 10 or more.
+'''
+import argparse
+import sqlite3
+import time
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from tinydb import TinyDB
+
+phase_codes = {"EF": 0, "EN": 1, "ER": 2, "EEPlus": 3}
+
+
+class GradeEngine():
+    def __init__(self, students: List[Tuple[int, str]], subject_ids: List[int],
+                 grades: Iterable[Tuple[int, int, str, int]]):
+        '''
+        students are (num, name) in ranking tie-break order and grades are
+        (student_num, subject_id, phase, value) rows.
+        '''
+        self.student_nums = np.array([num for num, _ in students], dtype=np.int64)
+        self.student_names = [name for _, name in students]
+        self.subject_ids = np.array(sorted(set(subject_ids)), dtype=np.int64)
+        student_index = {num: i for i, (num, _) in enumerate(students)}
+        subject_index = {id: i for i, id in enumerate(self.subject_ids.tolist())}
+
+        rows = [(student_index[num], subject_index[subject], phase_codes.get(phase, -1), value)
+                for num, subject, phase, value in grades
+                if num in student_index and subject in subject_index]
+        columns = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        self.student = columns[:, 0].astype(np.int32)
+        self.subject = columns[:, 1].astype(np.int16)
+        self.phase = columns[:, 2].astype(np.int8)
+        self.value = columns[:, 3].astype(np.int8)
+
+        self.best = np.zeros((len(students), len(self.subject_ids)), dtype=np.int8)
+        np.maximum.at(self.best, (self.student, self.subject), self.value)
+
+    @staticmethod
+    def from_sqlite(conn: sqlite3.Connection) -> "GradeEngine":
+        students = conn.execute(
+            "SELECT num, name FROM students ORDER BY rowid").fetchall()
+        subjects = [id for id, in conn.execute("SELECT id FROM subjects")]
+        grades = conn.execute(
+            "SELECT student_num, subject_id, phase, val FROM grades")
+        return GradeEngine(students, subjects, grades)
+
+    @staticmethod
+    def from_tinydb(db: TinyDB) -> "GradeEngine":
+        students = [(int(s["num"]), s["name"]) for s in db.table("students")]
+        subjects = [int(c["id"]) for c in db.table("courses")]
+        grades = ((int(g["num"]), int(g["course_id"]), phase,
+                   int(value) if value.isnumeric() else 0)
+                  for g in db.table("grades")
+                  for scores in g["scores"].values()
+                  for phase, value in scores.items())
+        return GradeEngine(students, subjects, grades)
+
+    def subject_columns(self, whitelist: Iterable) -> np.ndarray:
+        ids = np.array([int(id) for id in whitelist], dtype=np.int64)
+        ids = ids[np.isin(ids, self.subject_ids)]
+        return np.searchsorted(self.subject_ids, ids)
+
+    def averages(self, whitelist: Iterable = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns, for every student, the number of passed subjects of the
+        whitelist (all subjects if None) and the average of their best grades.
+        '''
+        best = self.best if whitelist is None \
+            else self.best[:, self.subject_columns(whitelist)]
+        passed = best >= 10
+        n_passed = passed.sum(axis=1)
+        total = np.where(passed, best, 0).sum(axis=1, dtype=np.int64)
+        avg = np.divide(total, n_passed, out=np.zeros(len(total)),
+                        where=n_passed != 0)
+        return n_passed, avg
+
+    def top_students(self, whitelist: List = None, n: int = 20) -> List[Tuple[str, int, float]]:
+        '''
+        Ranks the students that passed every subject of the whitelist by
+        their average. Ties keep the students order.
+        '''
+        required = len(self.subject_ids) if whitelist is None else len(whitelist)
+        n_passed, avg = self.averages(whitelist)
+        candidates = np.flatnonzero(n_passed == required)
+        order = candidates[np.argsort(-avg[candidates], kind="stable")][:n]
+        return [(self.student_names[i], int(n_passed[i]), float(avg[i]))
+                for i in order]
+
+
+if __name__ == "__main__":
+    import stats
+
+    parser = argparse.ArgumentParser(description="Top students ranking")
+    parser.add_argument("--db", default="sqlite.db")
+    parser.add_argument("--tinydb", action="store_true",
+                        help="load the grades from db.json instead of SQLite")
+    parser.add_argument("-n", type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.tinydb:
+        engine = GradeEngine.from_tinydb(stats.db)
+    else:
+        engine = GradeEngine.from_sqlite(sqlite3.connect(args.db))
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    top = engine.top_students(stats.whilelist2, args.n)
+    query_time = time.perf_counter() - start
+
+    for (name, n, avg) in top:
+        print(f"{name} - {avg:.2f} {n}")
+    print(f"Loaded {len(engine.value)} grades in {load_time * 1000:.1f} ms, "
+          f"ranked in {query_time * 1000:.2f} ms")
@@ -0,0 +1,210 @@
+'''
+Request rate limiting shared between sessions.
+
+TokenBucket is a fixed rate. AdaptiveLimiter finds the rate the server
+tolerates (AIMD: the rate grows slowly while the responses are fast and
+fine, and is cut when they fail or slow down) and caps the requests in
+flight, with priorities: registration requests go before scraping ones
+and always have reserved slots. shared(host) is the limiter of a host,
+used by every client.InforClient session of the process unless it is
+given another one.
+'''
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, Optional
+
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# priorities, lower goes first
+urgent = 0
+background = 10
+
+
+class TokenBucket():
+    '''
+    Allows rate requests per second on average, with bursts of up to burst
+    requests. acquire() blocks until a token is available.
+    '''
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int = background):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, latency: float, error: bool, endpoint: str = ""):
+        '''
+        Called with the outcome of every request that acquired a token, and
+        the endpoint it went to.
+        '''
+
+
+class AdaptiveLimiter(TokenBucket):
+    '''
+    Token bucket whose rate adapts to the server, with at most
+    max_concurrency requests in flight, reserved of them only for urgent
+    ones. Waiting requests go by priority, then in arrival order.
+
+    Until the first cut every healthy response adds increase to the rate,
+    so it about doubles every second (slow start). After it, a healthy
+    response adds increase / rate (about increase more requests per second
+    every second). An error (5xx, 429 or no response) or a smoothed latency
+    over latency_factor times the lowest seen (and at least latency_margin
+    ms over it) multiplies the rate by decrease, at most once per round
+    trip. Latencies are compared per endpoint, a pauta is always slower
+    than a HEAD ping.
+    '''
+
+    def __init__(self, rate: float = 20, burst: int = 20, min_rate: float = 1,
+                 max_rate: float = 200, max_concurrency: int = 8, reserved: int = 2,
+                 increase: float = 1, decrease: float = 0.5,
+                 latency_factor: float = 3, latency_margin: float = 100):
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.reserved = reserved
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latency_margin = latency_margin
+        self.condition = threading.Condition(self.lock)
+        self.waiting = []
+        self.order = itertools.count()
+        self.active = 0
+        # smoothed latency of all the requests, and the smoothed and lowest
+        # latency of every endpoint, in ms
+        self.round_trip: Optional[float] = None
+        self.latency: Dict[str, float] = {}
+        self.baseline: Dict[str, float] = {}
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.errors = 0
+
+    def acquire(self, priority: int = background):
+        start = time.perf_counter()
+        with self.condition:
+            entry = (priority, next(self.order))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                slots = self.max_concurrency - (0 if priority <= urgent else self.reserved)
+                wait = None
+                if self.waiting[0] == entry and self.active < slots:
+                    self.refill()
+                    if self.tokens >= 1:
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait)
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.active += 1
+            # the next one may go too
+            self.condition.notify_all()
+        metrics.registry.observe("ratelimit_wait_ms", (time.perf_counter() - start) * 1000,
+                                 priority=str(priority))
+
+    def release(self, latency: float, error: bool, endpoint: str = ""):
+        with self.condition:
+            self.active -= 1
+            reason = self.observe(latency, error, endpoint)
+            self.condition.notify_all()
+        if reason is not None:
+            metrics.registry.inc("ratelimit_decreases_total", reason=reason)
+
+    def observe(self, latency: float, error: bool, endpoint: str = "") -> Optional[str]:
+        '''Adapts the rate, returns why it was cut, if it was.'''
+        if error:
+            self.errors += 1
+            return self.cut("error")
+        self.round_trip = latency if self.round_trip is None else \
+            0.8 * self.round_trip + 0.2 * latency
+        smoothed = self.latency.get(endpoint)
+        smoothed = self.latency[endpoint] = latency if smoothed is None else \
+            0.8 * smoothed + 0.2 * latency
+        baseline = self.baseline[endpoint] = min(self.baseline.get(endpoint, latency), latency)
+        if smoothed > max(self.latency_factor * baseline, baseline + self.latency_margin):
+            return self.cut("latency")
+        step = self.increase if self.decreases == 0 else self.increase / self.rate
+        self.rate = min(self.max_rate, self.rate + step)
+        return None
+
+    def cut(self, reason: str) -> Optional[str]:
+        now = time.monotonic()
+        round_trip = (self.round_trip or 0) / 1000
+        if now - self.last_decrease < max(round_trip, 0.1):
+            return None
+        self.refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.last_decrease = now
+        self.decreases += 1
+        return reason
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"rate": self.rate, "active": self.active, "waiting": len(self.waiting),
+                    "latency_ms": dict(self.latency), "baseline_ms": dict(self.baseline),
+                    "decreases": self.decreases, "errors": self.errors}
+
+
+limiters: Dict[str, AdaptiveLimiter] = {}
+limiters_lock = threading.Lock()
+
+
+def shared(host: str) -> AdaptiveLimiter:
+    '''The process wide limiter of host, created on first use.'''
+    with limiters_lock:
+        limiter = limiters.get(host)
+        if limiter is None:
+            limiter = limiters[host] = AdaptiveLimiter()
+        return limiter
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter that takes a token from the limiter before every request,
+    with its priority, so all the sessions it is mounted on share the same
+    rate. The limiter is told how every request went, and to which
+    endpoint (method and metrics.endpoint of the url). The ms the request
+    waited for the limiter are in the ratelimit_wait_ms attribute of the
+    response, r.elapsed counts them too.
+    '''
+
+    def __init__(self, limiter: TokenBucket, *args, priority: int = background, **kwargs):
+        self.limiter = limiter
+        self.priority = priority
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        queued = time.perf_counter()
+        self.limiter.acquire(self.priority)
+        start = time.perf_counter()
+        error = True
+        try:
+            r = super().send(request, **kwargs)
+            r.ratelimit_wait_ms = (start - queued) * 1000
+            error = r.status_code >= 500 or r.status_code == 429
+            return r
+        finally:
+            self.limiter.release((time.perf_counter() - start) * 1000, error,
+                                 f"{request.method} {metrics.endpoint(request.url)}")
@@ -0,0 +1,150 @@
+'''
+Pivot report of the grades: one row per student, one column per subject
+short name (subjects.sname, see database.gen_subject_snames) with the best
+grade, plus the average of those columns.
+
+The query reads only the covering index on grades(student_num, subject_id,
+val, year), grouping in index order, so it is a single pass over grades.
+The index is part of the schema (database.create_table_SQL), report()
+creates it in databases made before it was.
+'''
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from functools import lru_cache
+from typing import Dict, List, Optional, TextIO, Tuple
+
+import database
+
+def subject_ids_by_sname(conn: sqlite3.Connection) -> Dict[str, List[int]]:
+    '''Some short names are shared by more than one subject (e.g. TC).'''
+    ids = {}
+    for id, sname in conn.execute("SELECT id, sname FROM subjects ORDER BY sname, id"):
+        if sname is not None:
+            ids.setdefault(sname, []).append(id)
+    return ids
+
+
+def quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+@lru_cache(maxsize=32)
+def pivot_SQL(subject_counts: Tuple[Tuple[str, int], ...], student_filter: str, by_year: bool) -> str:
+    '''
+    Builds the pivot query for the (sname, number of subject ids) columns.
+    Only the shape is in the SQL, ids and filter values are parameters, so
+    the same string (and sqlite3's prepared statement) is reused.
+    '''
+    columns = []
+    for sname, n in subject_counts:
+        ids = ", ".join("?" * n)
+        columns.append(
+            f"max(CASE WHEN gr.subject_id IN ({ids}) THEN gr.val END) AS {quote(sname)}")
+    snames = [quote(sname) for sname, _ in subject_counts]
+    total = " + ".join(f"coalesce({s}, 0)" for s in snames)
+    count = " + ".join(f"({s} IS NOT NULL)" for s in snames)
+
+    all_ids = ", ".join("?" * sum(n for _, n in subject_counts))
+    where = [f"gr.subject_id IN ({all_ids})"]
+    if by_year:
+        where.append("gr.year = ?")
+    if student_filter == "name":
+        where.append("gr.student_num IN (SELECT num FROM students WHERE name LIKE ?)")
+    elif student_filter == "num":
+        where.append("gr.student_num = ?")
+
+    return f"""
+    SELECT st.name, p.*, ({total}) * 1.0 / nullif({count}, 0) AS media
+    FROM (
+        SELECT gr.student_num AS num, {", ".join(columns)}
+        FROM grades AS gr
+        WHERE {" AND ".join(where)}
+        GROUP BY gr.student_num
+    ) AS p
+    LEFT JOIN students AS st ON st.num = p.num
+    """
+
+
+def report(conn: sqlite3.Connection, snames: List[str] = None,
+           student: Optional[str] = None, year: Optional[str] = None) -> sqlite3.Cursor:
+    '''
+    Returns a cursor over the report rows: name, num, one column per sname
+    and media. student is a student number or a LIKE pattern on the name.
+    '''
+    # only does something the first time, on a database without the index
+    database.create_table(conn, database.create_table_SQL)
+    ids = subject_ids_by_sname(conn)
+    if snames is None:
+        snames = list(ids)
+    unknown = [s for s in snames if s not in ids]
+    if unknown:
+        raise ValueError(f"Unknown subject short names: {', '.join(unknown)}")
+
+    student_filter = None
+    if student is not None:
+        student_filter = "num" if student.isnumeric() else "name"
+
+    sql = pivot_SQL(tuple((s, len(ids[s])) for s in snames),
+                    student_filter, year is not None)
+    params = [id for s in snames for id in ids[s]] * 2
+    if year is not None:
+        params.append(year)
+    if student_filter == "num":
+        params.append(int(student))
+    elif student_filter == "name":
+        params.append(student)
+    return conn.execute(sql, params)
+
+
+def write_csv(cursor: sqlite3.Cursor, out: TextIO):
+    writer = csv.writer(out)
+    writer.writerow(c[0] for c in cursor.description)
+    for row in cursor:
+        writer.writerow(row)
+
+
+def write_json(cursor: sqlite3.Cursor, out: TextIO):
+    columns = [c[0] for c in cursor.description]
+    out.write("[")
+    for i, row in enumerate(cursor):
+        out.write(",\n" if i else "\n")
+        json.dump(dict(zip(columns, row)), out, ensure_ascii=False)
+    out.write("\n]\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grades pivot report")
+    parser.add_argument("snames", nargs="*",
+                        help="subject short names, all subjects if none given")
+    parser.add_argument("--db", default="sqlite.db")
+    parser.add_argument("--student",
+                        help="student number or name LIKE pattern")
+    parser.add_argument("--year", help="school year, e.g. 2019-2020")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("-o", "--output", help="output file, stdout if not given")
+    parser.add_argument("--gen-snames", action="store_true",
+                        help="regenerate subjects.sname first")
+    args = parser.parse_args()
+
+    if args.gen_snames:
+        database.gen_subject_snames(args.db)
+    conn = database.create_conn(args.db)
+    if conn is None:
+        exit(1)
+
+    try:
+        cursor = report(conn, args.snames or None, args.student, args.year)
+    except ValueError as e:
+        print(f"{e}. Run with --gen-snames to regenerate the short names")
+        conn.close()
+        exit(1)
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        (write_csv if args.format == "csv" else write_json)(cursor, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
@@ -1,115 +1,488 @@
 from genericpath import exists
-import urllib3
-import urllib
 import json
 from bs4 import BeautifulSoup
 import time
 import os
-from urllib3 import request
-
-from urllib3.util.url import Url
+import argparse
+import configparser
+import hashlib
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+
+import requests
+from requests.sessions import Session
+
+import metrics
+from archive import Archive
+from client import InforClient, SessionExpired, parse_page
+from jobs import Job, JobQueue, jobs_file_name
 
 infor_base_url = "https://inforestudante.uc.pt"
 infor_url = "https://inforestudante.uc.pt/nonio/security/login.do"
+infor_pautas_base = infor_base_url + "/nonio/pautas/"
 
-form_data = {"username": "", "password": ""}
 excude_years = ["2015/2016", "2016/2017"]
 
-
-def saca_disciplinas(page: BeautifulSoup, path):
-
-    detalhes_buttons = page.find_all(class_="botaodetalhes")
-
-    for button in detalhes_buttons:
+# Concurrent download settings
+workers = 8
+max_host_connections = 8
+client = InforClient(infor_base_url, max_connections=max_host_connections)
+# the logged in session, see scrap_login
+session: Optional[Session] = None
+relogin_lock = threading.Lock()
+# the year selected in the server session, the pautas are served for it,
+# and the url that selects it
+selected_year: Optional[str] = None
+select_url: Optional[str] = None
+
+# Incremental scraping. The manifest keeps, for every downloaded file, the
+# hash of its content and the validators sent by the server.
+manifest_file_name = "./pautas/manifest.json"
+changed_file_name = "./pautas/changed.txt"
+manifest = {}
+changed_files = []
+manifest_lock = threading.Lock()
+# If set, the pautas are stored in this archive instead of ./pautas files,
+# keyed by their path relative to ./pautas
+archive: Optional[Archive] = None
+
+
+def load_manifest():
+    global manifest
+    try:
+        with open(manifest_file_name) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+
+def load_changed():
+    '''The changed files of the scrape being resumed.'''
+    global changed_files
+    try:
+        with open(changed_file_name) as f:
+            changed_files = f.read().split("\n")[:-1]
+    except FileNotFoundError:
+        changed_files = []
+
+
+def save_manifest():
+    os.makedirs(os.path.dirname(manifest_file_name), exist_ok=True)
+    with open(manifest_file_name, "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=4)
+    with open(changed_file_name, "w") as f:
+        f.writelines(file + "\n" for file in sorted(changed_files))
+
+
+def archive_key(file: str) -> str:
+    return "/".join(file.split("/")[-2:])
+
+
+def stored(file: str) -> bool:
+    if archive is not None:
+        return archive_key(file) in archive.pages
+    return os.path.exists(file)
+
+
+def conditional_headers(file: str) -> dict:
+    entry = manifest.get(file)
+    if entry is None or not stored(file):
+        return {}
+    h = {}
+    if entry.get("etag"):
+        h["If-None-Match"] = entry["etag"]
+    if entry.get("last-modified"):
+        h["If-Modified-Since"] = entry["last-modified"]
+    return h
+
+
+def fetch_pauta(name: str, href: str, path: str) -> Optional[float]:
+    '''
+    Downloads a single pauta and writes it to {path}/{name}.html, unless the
+    server or the content hash says it did not change since the last run.
+    Returns the request latency in milliseconds, without the wait for the
+    rate limiter (see the ratelimit_wait_ms metric), or None if the request
+    failed.
+    '''
+    file = f"{path}/{name}.html"
+    start = time.perf_counter()
+    r = client.pauta(session, href, headers=conditional_headers(file))
+    latency = (time.perf_counter() - start) * 1000 - getattr(r, "ratelimit_wait_ms", 0)
+    if client.expired(r):
+        raise SessionExpired(name)
+
+    print(f"GET {name} status: {r.status_code} ({latency:.0f} ms)")
+    if r.status_code == 304:
+        return latency
+    if r.status_code != 200:
+        return None
+
+    digest = hashlib.sha256(r.content).hexdigest()
+    entry = {"sha256": digest,
+             "etag": r.headers.get("ETag"),
+             "last-modified": r.headers.get("Last-Modified")}
+    with manifest_lock:
+        unchanged = manifest.get(file, {}).get("sha256") == digest
+        manifest[file] = entry
+    if unchanged and stored(file):
+        print(f"\t{name} unchanged")
+        return latency
+
+    if archive is not None:
+        archive.put(archive_key(file), r.content)
+    else:
+        os.makedirs(path, exist_ok=True)
+        with open(file, "w") as f:
+            f.write(r.content.decode())
+    with manifest_lock:
+        changed_files.append(archive_key(file) if archive is not None else file)
+    return latency
+
+
+def set_base_url(url: str, max_connections: int = None):
+    '''
+    Points the scrapper, and its client, to another server, e.g.
+    mock_server.py, with at most max_connections to it if given.
+    '''
+    global infor_base_url, infor_url, infor_pautas_base
+    infor_base_url = url
+    infor_url = infor_base_url + "/nonio/security/login.do"
+    infor_pautas_base = infor_base_url + "/nonio/pautas/"
+    if max_connections is not None:
+        client.max_connections = max_connections
+    # also drops the connection pool, the next one has the new limit
+    client.set_base_url(url)
+
+
+def saca_disciplinas(page: BeautifulSoup, path, executor: ThreadPoolExecutor = None) -> List[Future]:
+    '''
+    Downloads every pauta linked from the year page, concurrently if an
+    executor is given. Returns only once they are all done (the futures),
+    the server serves the pautas of the year selected in the session, so
+    the next year must not be selected while they download.
+    '''
+    futures = []
+    for name, href in pauta_links(page):
+        if executor is None:
+            fetch_pauta(name, href, path)
+        else:
+            futures.append(executor.submit(fetch_pauta, name, href, path))
+    wait(futures)
+    return futures
+
+
+def pauta_links(page: BeautifulSoup) -> List[Tuple[str, str]]:
+    '''
+    The (course name, href) of every pauta linked from the year page.
+    '''
+    links = []
+    for button in page.find_all(class_="botaodetalhes"):
         name = button.parent.parent.contents[1].text  # 0 is newline
-
-        r = http.request(
-            'GET', "https://inforestudante.uc.pt/nonio/pautas/"+button['href'], headers=headers)
-
-        print(f"GET {name} status: {r.status}")
-        if r.status != 200:
+        links.append((name, button['href']))
+    return links
+
+
+def report_latencies(latencies: List[float], failed: int):
+    latencies = sorted(latencies)
+    if not latencies:
+        print(f"No pautas downloaded, {failed} failed attempts")
+        return
+    mean = sum(latencies) / len(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"Downloaded {len(latencies)} pautas, {failed} failed attempts. "
+          f"Latency mean {mean:.0f} ms, p95 {p95:.0f} ms, max {latencies[-1]:.0f} ms")
+
+
+def load_credentials(file_name: str = "configs.ini"):
+    '''
+    Sets the client username and password to the ones of the bot configs
+    file, unless they are already set.
+    '''
+    if client.username:
+        return
+    config = configparser.ConfigParser()
+    config.read(file_name)
+    client.username = config["DEFAULT"].get("username", "")
+    client.password = config["DEFAULT"].get("password", "")
+
+
+def scrap_login() -> Optional[str]:
+    '''
+    Logs a new session in with the client credentials and makes it the
+    scrapper session. Returns the pautas url, or None if it failed.
+    '''
+    global session
+    session = client.new_session()
+    success, r = client.login(session)
+    print(f"POST Login request status: {r.status_code}")
+    pautas_url = client.pautas_url(r) if success else None
+    if pautas_url is None:
+        print("Login failed")
+    return pautas_url
+
+
+def year_info(page: BeautifulSoup) -> Tuple[str, str, List[str]]:
+    '''
+    The selected year, the url to select another one and the year options
+    of a pautas year page.
+    '''
+    return client.year_info(page)
+
+
+def pautas_years(pautas_url: str) -> Iterator[Tuple[str, BeautifulSoup]]:
+    '''
+    Yields the (year, page) of every year not in excude_years, the current
+    one first. Raises an Exception if a year page can not be fetched.
+    Unlike client.pautas_years, every year is selected with the scrapper
+    session of the moment, a relogin while a year downloads replaces it.
+    '''
+    page = page_of(session.get(pautas_url), pautas_url)
+    year, next_url, options = year_info(page)
+    print(f"GET ano {year}")
+    yield year, page
+
+    for ano in options[1:]:
+        if ano in excude_years:
             continue
-
-        if not os.path.isdir(path):
-            os.makedirs(path, exist_ok=True)
-        with open(f"{path}/{name}.html", "w") as f:
-            f.write(r.data.decode())
+        sent = time.time()
+        try:
+            page = page_of(client.select_year(session, next_url, ano), next_url)
+        except SessionExpired:
+            relogin(sent)
+            page = page_of(client.select_year(session, next_url, ano), next_url)
+        year, next_url, _ = year_info(page)
+        print(f"GET ano {year}")
+        yield year, page
+
+
+def relogin(since: float):
+    '''
+    Logs a new session in, unless another worker already did after since
+    (when its request was sent), and selects the year of the old one in it
+    before it replaces the scrapper session. The other workers keep
+    sending with the old session meanwhile, so none of their requests is
+    served for the default year of the new server session.
+    '''
+    global session, selected_year
+    with relogin_lock:
+        if getattr(session, "logged_in_at", 0) > since:
+            return
+        new = client.new_session()
+        success, _ = client.login(new)
+        print(f"Session expired, login {'succeeded' if success else 'failed'}")
+        year = None
+        if success and selected_year is not None and select_url is not None:
+            try:
+                r = client.select_year(new, select_url, selected_year)
+                if r.status_code == 200 and not client.expired(r):
+                    year = selected_year
+            except requests.RequestException as e:
+                print(f"Selecting {selected_year} again failed: {e}")
+        selected_year = year
+        session = new
+
+
+def page_of(r: requests.Response, url: str) -> BeautifulSoup:
+    if client.expired(r):
+        raise SessionExpired(url)
+    if r.status_code != 200:
+        raise requests.HTTPError(f"{url} status: {r.status_code}", response=r)
+    return parse_page(r.content, "pautas-year")
+
+
+def years_job(jobs: JobQueue, job: Job):
+    '''
+    The pautas page: queues every year not in excude_years. The page is
+    the current year one, so its pautas are queued right away.
+    '''
+    global selected_year, select_url
+    page = page_of(session.get(job.url), job.url)
+    year, next_url, options = year_info(page)
+    selected_year, select_url = year, next_url
+    print(f"GET {job.url} years: {', '.join(options)}")
+    for ano in options:
+        if ano not in excude_years:
+            jobs.add(ano, "", next_url)
+    if year not in excude_years:
+        for name, href in pauta_links(page):
+            jobs.add(year, name, href)
+        jobs.done(Job(year, "", next_url))
+
+
+def year_job(jobs: JobQueue, job: Job):
+    '''A year page: selects the year in the session and queues its pautas.'''
+    global selected_year, select_url
+    page = page_of(client.select_year(session, job.url, job.year), job.url)
+    selected_year, select_url = job.year, job.url
+    links = pauta_links(page)
+    print(f"GET ano {job.year}: {len(links)} pautas")
+    for name, href in links:
+        jobs.add(job.year, name, href)
+
+
+def run_job(jobs: JobQueue, job: Job) -> Optional[float]:
+    '''
+    Fetches the page of a job and records the outcome in the queue, so a
+    page is only done again if it failed. Returns the latency of a
+    downloaded pauta.
+    '''
+    sent = time.time()
+    latency = None
+    try:
+        if job.year == "":
+            years_job(jobs, job)
+        elif job.course == "":
+            year_job(jobs, job)
+        else:
+            if selected_year != job.year:
+                raise requests.RequestException(f"{job.year} is not the selected year")
+            latency = fetch_pauta(job.course, job.url, f"./pautas/{job.year.replace('/', '-')}")
+            if latency is None:
+                raise requests.HTTPError("request failed")
+    except SessionExpired:
+        relogin(sent)
+        jobs.fail(job, "session expired")
+        return None
+    except requests.RequestException as e:
+        print(f"{job.year} {job.course}: {e}, attempt {job.attempts + 1}")
+        jobs.fail(job, str(e))
+        return None
+    jobs.done(job)
+    return latency
+
+
+def checkpoint():
+    save_manifest()
+    if archive is not None:
+        archive.save()
+
+
+def run_year(jobs: JobQueue, year: str, executor: ThreadPoolExecutor) -> Tuple[List[float], int]:
+    '''
+    Selects year in the server session, by running its year page job
+    (again, unless the year is already selected), then downloads its due
+    pautas on the executor. They are all done before another year can be
+    selected. The year page job keeps its backoff: while it waits the
+    pautas wait with it, and they are given up on with it.
+    Returns the latencies of the downloaded pautas and the failed attempts.
+    '''
+    listing = jobs.get(year, "")
+    due = listing.state == "pending" and listing.next_attempt <= time.time()
+    if due or (selected_year != year and listing.state == "done"):
+        run_job(jobs, listing)
+    pautas = [job for job in jobs.due(year) if job.course != ""]
+    if selected_year != year:
+        for job in pautas:
+            if listing.state == "failed":
+                jobs.give_up(job, "year page failed")
+            else:
+                jobs.defer(job, listing.next_attempt)
+        return [], 0
+
+    latencies = []
+    failed = 0
+    futures = [executor.submit(run_job, jobs, job) for job in pautas]
+    for future, job in zip(futures, pautas):
+        latency = future.result()
+        if latency is not None:
+            latencies.append(latency)
+        elif job.state != "done":
+            failed += 1
+    return latencies, failed
+
+
+def run_jobs(jobs: JobQueue, executor: ThreadPoolExecutor) -> Tuple[List[float], int]:
+    '''
+    Runs the due jobs until none is pending: the pautas page, then a year
+    at a time (see run_year), checkpointing after every round. Failed jobs
+    wait for their backoff.
+    Returns the latencies of the downloaded pautas and the failed attempts.
+    '''
+    latencies = []
+    failed = 0
+    while True:
+        due = jobs.due()
+        if not due:
+            wait = jobs.next_due_in()
+            if wait is None:
+                return latencies, failed
+            time.sleep(wait)
+            continue
+        for year, year_jobs in itertools.groupby(due, key=lambda job: job.year):
+            if year == "":
+                for job in year_jobs:
+                    run_job(jobs, job)
+                continue
+            year_latencies, year_failed = run_year(jobs, year, executor)
+            latencies += year_latencies
+            failed += year_failed
+        checkpoint()
 
 
 if __name__ == "__main__":
-    http = urllib3.PoolManager()
-
-    # GET infor page
-    r = http.request('GET', infor_url)
-    print(f"GET {infor_url}, status: {r.status}")
-    if r.status != 200:
-        exit()
-
-    page = BeautifulSoup(r.data, 'html.parser')
-    cookie = r.headers["Set-Cookie"].split()[0]
-    headers = {"Cookie": cookie}
-
-    login_form = page.find(id="loginFormBean")
-    action = login_form["action"]
-
-    login_url = infor_base_url+action
-
-    # POST login attempt
-
-    r = http.request('POST', login_url, fields=form_data, retries=5)
-
-    print(f"POST Login request status: {r.status}")
-    if r.status != 200:
-        exit()
-
-    # GET pautas
-    page = BeautifulSoup(r.data, 'html.parser')
-    m = page.find(class_="menu_30")
-    pautas_url = urllib.parse.urljoin(
-        "https://inforestudante.uc.pt/nonio/dashboard/dashboard.do", m.parent['href'])
-
-    r = http.request('GET', pautas_url, headers=headers)
-    print(f"GET {pautas_url} status: {r.status}")
-    if r.status != 200:
+    parser = argparse.ArgumentParser(description="Download pautas")
+    parser.add_argument("--workers", type=int, default=workers,
+                        help="number of concurrent pauta downloads")
+    parser.add_argument("--max-connections", type=int, default=max_host_connections,
+                        help="maximum open connections to inforestudante")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the manifest and download every pauta")
+    parser.add_argument("--metrics",
+                        help="write the metrics here at the end (.prom for Prometheus text, else JSON lines)")
+    parser.add_argument("--trace", help="JSON lines file to append every HTTP request to")
+    parser.add_argument("--base-url", default=infor_base_url,
+                        help="server to use, e.g. a mock_server.py url")
+    parser.add_argument("--archive",
+                        help="store the pautas in this compressed archive (see archive.py)")
+    parser.add_argument("--jobs", default=jobs_file_name,
+                        help="job queue of the scrape, an unfinished one is resumed")
+    parser.add_argument("--restart", action="store_true",
+                        help="start over even if the last scrape did not finish")
+    parser.add_argument("--max-attempts", type=int, default=6,
+                        help="attempts of a page before giving up on it")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="when resuming, also retry the pages given up on")
+    args = parser.parse_args()
+    set_base_url(args.base_url, args.max_connections)
+    if args.archive:
+        archive = Archive(args.archive)
+    metrics.trace_file_name = args.trace
+    load_credentials()
+
+    if not args.full:
+        load_manifest()
+
+    os.makedirs(os.path.dirname(args.jobs) or ".", exist_ok=True)
+    jobs = JobQueue(args.jobs, max_attempts=args.max_attempts)
+    if args.retry_failed and not args.restart:
+        print(f"Retrying {jobs.retry_failed()} failed pages")
+    if args.restart or jobs.finished():
+        jobs.reset()
+    else:
+        load_changed()
+        print(f"Resuming the last scrape: {jobs.counts()}")
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    pautas_url = scrap_login()
+    if pautas_url is None:
         exit()
 
-    # for each year
-    page = BeautifulSoup(r.data, 'html.parser')
-    tr = page.find(id="linhaAnoLectivoMinhasUc")
-    select = tr.contents[3].contents[1]
-    options = select.find_all("option")
-
-    selected = select.find(selected="selected")
-    year = selected["value"]
-
-    next_arg = select["onchange"].split("'")[1]
-    next_url = "https://inforestudante.uc.pt/nonio/pautas/"+next_arg
-
-    path = f"./pautas/{year.replace('/','-')}"
-
-    saca_disciplinas(page, path)
-
-    # download other years
-    for option in options[1:]:
-        ano = option["value"]
-        if ano in excude_years:
-            continue
-        r = http.request("POST", next_url, headers=headers, fields={
-                         "anoLectivoMinhasUCSeleccionado": ano})
-        print(f"GET ano {ano} status: {r.status}")
-        if r.status != 200:
-            exit()
-
-        page = BeautifulSoup(r.data, 'html.parser')
-        tr = page.find(id="linhaAnoLectivoMinhasUc")
-        select = tr.contents[3].contents[1]
-
-        selected = select.find(selected="selected")
-        year = selected["value"]
-
-        next_arg = select["onchange"].split("'")[1]
-        next_url = "https://inforestudante.uc.pt/nonio/pautas/"+next_arg
-
-        path = f"./pautas/{year.replace('/','-')}"
-
-        saca_disciplinas(page, path)
+    jobs.add("", "", pautas_url)
+    latencies, failed = run_jobs(jobs, executor)
+
+    executor.shutdown(wait=True)
+    report_latencies(latencies, failed)
+    for job in jobs.failed():
+        print(f"Gave up on {job.year} {job.course or 'year page'} after {job.attempts} attempts")
+    print(metrics.summary())
+    if args.metrics:
+        metrics.write(args.metrics)
+
+    save_manifest()
+    jobs.close()
+    if archive is not None:
+        archive.close()
+    print(f"{len(changed_files)} changed pautas listed in {changed_file_name}")
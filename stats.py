@@ -1,18 +1,43 @@
+from collections import defaultdict
 from typing import Dict, List, Tuple
-from tinydb import TinyDB, Query, where
+from tinydb import TinyDB
 
 db = TinyDB("db.json")
 students_db = db.table("students")
 courses_db = db.table("courses")
 grades_db = db.table("grades")
 
+# Hash indexes over the TinyDB tables, built once by build_indexes
+grades_by_num: Dict[str, List[Dict]] = None
+course_names: Dict[str, str] = None
+
+
+def build_indexes():
+    '''
+    Indexes the grades by student number and the course names by id, so the
+    queries below don't scan the whole tables for every student.
+    '''
+    global grades_by_num, course_names
+    grades_by_num = defaultdict(list)
+    for grade in grades_db:
+        grades_by_num[grade["num"]].append(grade)
+    course_names = {}
+    for course in courses_db:
+        course_names.setdefault(course["id"], course["name"])
+
+
+def student_grades(num: str) -> List[Dict]:
+    if grades_by_num is None:
+        build_indexes()
+    return grades_by_num.get(num, [])
+
 
 def best_score(scores: Dict) -> str:
     best = 0
     for scores in scores.values():
         for value in scores.values():
-            if value.isnumeric() and eval(value) > best:
-                best = eval(value)
+            if value.isnumeric() and int(value) > best:
+                best = int(value)
     return best if best >= 10 else 0
 
 
@@ -30,10 +55,9 @@ def get_student_grades(num=None, **kwargs):
         raise NotImplementedError
 
     else:
-        grades = grades_db.search(where("num") == num)
+        grades = student_grades(num)
         for grade in grades:
-            course_name = courses_db.get(
-                where("id") == grade["course_id"])["name"]
+            course_name = course_names[grade["course_id"]]
             print(f"{course_name} - {best_score(grade['scores'])}")
 
 
@@ -63,7 +87,7 @@ def student_average(grades: List[Dict]) -> Tuple[int, float]:
 def get_top_students(n=20):
     top_list = []
     for student in students_db:
-        scores = grades_db.search(where("num") == student["num"])
+        scores = student_grades(student["num"])
         (n_courses, avg) = student_average(scores)
         if n_courses == len(whilelist2):
             top_list.append((student["name"], (n_courses, avg)))
@@ -76,4 +100,5 @@ def get_top_students(n=20):
 # get_student_grades("2015231448")
 
 
-get_top_students()
+if __name__ == "__main__":
+    get_top_students()
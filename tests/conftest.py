@@ -0,0 +1,72 @@
+'''
+Fixtures that run the bot and the scrapper against mock_server.py. Every
+test runs in its own temporary directory, so the files they write (logs,
+turmas.json, ./pautas, the job queue) never touch the repository.
+'''
+import configparser
+import json
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import bot  # noqa: E402
+import mock_server  # noqa: E402
+import scrap  # noqa: E402
+from page_cache import ParseCache  # noqa: E402
+
+lab_zone = "Práticas-Laboratoriais"
+
+
+@pytest.fixture
+def mock(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mock_server, "subject_page_file_name", os.path.join(root, "test.html"))
+    server = mock_server.MockInforestudante(pautas=os.path.join(root, "pautas")).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def infor_bot(mock, monkeypatch):
+    '''The bot module pointed to the mock, logged in as u.'''
+    bot.set_base_url(mock.url)
+    monkeypatch.setattr(bot, "page_cache", ParseCache(None))
+    config = configparser.ConfigParser()
+    config.read_dict({"DEFAULT": {"username": "u", "password": "p"}})
+    monkeypatch.setattr(bot, "config", config)
+    return bot
+
+
+@pytest.fixture
+def scrapper(mock, monkeypatch):
+    '''The scrap module pointed to the mock, with a fresh state.'''
+    scrap.set_base_url(mock.url)
+    monkeypatch.setattr(scrap.client, "username", "u")
+    monkeypatch.setattr(scrap.client, "password", "p")
+    monkeypatch.setattr(scrap, "session", None)
+    monkeypatch.setattr(scrap, "selected_year", None)
+    monkeypatch.setattr(scrap, "select_url", None)
+    monkeypatch.setattr(scrap, "manifest", {})
+    monkeypatch.setattr(scrap, "changed_files", [])
+    monkeypatch.setattr(scrap, "archive", None)
+    return scrap
+
+
+def prepare_shot(bot, mock, want):
+    '''
+    Writes a turmas.json that wants the turmas of want (in order) in the
+    lab zone of the mock subject, and prepares its enrolment POST.
+    Returns the shot and its logged in session.
+    '''
+    with open(bot.turmas_file_name, "w") as f:
+        json.dump({mock.subject_name: {lab_zone: {"want": want, "options": []}}}, f)
+    session = bot.new_session()
+    _, res = bot.navigate_subjects_page(session)
+    subjects = bot.extract_subjects(res)
+    payloads = bot.gen_payloads(subjects, session, bot.load_turmas(subjects, session))
+    assert len(payloads) == 1
+    return bot.prepare_shot(payloads[0], session), session
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from jobs import Job, JobQueue, retry_delay
+
+
+@pytest.fixture
+def queue(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.db"), max_attempts=2, base_delay=10)
+    yield jobs
+    jobs.close()
+
+
+def keys(jobs):
+    return [(job.year, job.course) for job in jobs]
+
+
+def test_due_order(queue):
+    queue.add("2018/2019", "b", "b.do")
+    queue.add("2018/2019", "", "year.do")
+    queue.add("2019/2020", "a", "a.do")
+    queue.add("", "", "init.do")
+    assert keys(queue.due()) == [("", ""), ("2019/2020", "a"),
+                                 ("2018/2019", ""), ("2018/2019", "b")]
+    assert keys(queue.due("2018/2019")) == [("2018/2019", ""), ("2018/2019", "b")]
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    jobs = JobQueue(path)
+    for course in "abc":
+        jobs.add("2019/2020", course, f"{course}.do")
+    jobs.done(Job("2019/2020", "a", "a.do"))
+    jobs.close()
+
+    jobs = JobQueue(path)
+    assert not jobs.finished()
+    # queuing a done page again does not redo it
+    jobs.add("2019/2020", "a", "a.do")
+    due = jobs.due()
+    assert keys(due) == [("2019/2020", "b"), ("2019/2020", "c")]
+    for job in due:
+        jobs.done(job)
+    assert jobs.finished()
+    assert jobs.counts() == {"done": 3}
+    jobs.close()
+
+
+def test_failed_job_waits_for_its_backoff(queue):
+    queue.add("2019/2020", "a", "a.do")
+    job, = queue.due()
+    queue.fail(job, "503")
+    assert job.state == "pending"
+    assert queue.due() == []
+    assert 0 <= queue.next_due_in() <= 20
+    assert queue.get("2019/2020", "a").attempts == 1
+
+
+def test_job_is_given_up_after_max_attempts(queue):
+    queue.add("2019/2020", "a", "a.do")
+    job, = queue.due()
+    queue.fail(job, "503")
+    queue.fail(job, "503")
+    assert job.state == "failed"
+    assert queue.next_due_in() is None
+    assert queue.finished()
+    assert keys(queue.failed()) == [("2019/2020", "a")]
+
+    assert queue.retry_failed() == 1
+    job, = queue.due()
+    assert (job.state, job.attempts) == ("pending", 0)
+
+
+def test_defer_and_give_up(queue):
+    queue.add("2019/2020", "a", "a.do")
+    queue.add("2019/2020", "b", "b.do")
+    a, b = queue.due()
+    queue.defer(a, time.time() + 60)
+    queue.give_up(b, "year page failed")
+    assert queue.due() == []
+    assert queue.get("2019/2020", "a").attempts == 0
+    assert 59 <= queue.next_due_in() <= 60
+    assert keys(queue.failed()) == [("2019/2020", "b")]
+
+
+def test_retry_delay_bounds():
+    for attempts in range(12):
+        for _ in range(20):
+            assert 0 <= retry_delay(attempts, base=1, cap=300) <= min(300, 2 ** attempts)
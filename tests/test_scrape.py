@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import pipeline
+from conftest import root
+from jobs import JobQueue
+
+years = ["2017-2018", "2018-2019", "2019-2020"]
+pautas = {year: sorted(f for f in os.listdir(os.path.join(root, "pautas", year))
+                       if f.endswith(".html"))
+          for year in years}
+
+
+@pytest.fixture
+def expire_once(mock, monkeypatch):
+    '''
+    Logs every session out on the after-th call of module.name, a pauta
+    download, partway through the scrape.
+    '''
+    def expire(module, name, after=5):
+        calls = []
+        download = getattr(module, name)
+
+        def expiring(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == after:
+                mock.sessions.clear()
+            return download(*args, **kwargs)
+        monkeypatch.setattr(module, name, expiring)
+    return expire
+
+
+def detail_years(mock):
+    '''The year of every pauta request, in the order they were served.'''
+    return [parse_qs(urlsplit(path).query)["ano"][0]
+            for _, path in mock.requests if urlsplit(path).path.endswith("detalhe.do")]
+
+
+def logins(mock):
+    return sum(1 for method, path in mock.requests
+               if method == "POST" and urlsplit(path).path.endswith("login.do"))
+
+
+def run_jobs(scrapper, tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.db"), base_delay=0.01, max_delay=0.05)
+    jobs.add("", "", scrapper.scrap_login())
+    with ThreadPoolExecutor(4) as executor:
+        latencies, failed = scrapper.run_jobs(jobs, executor)
+    return jobs, latencies, failed
+
+
+def test_run_jobs_fetches_a_year_at_a_time(scrapper, mock, tmp_path):
+    jobs, latencies, failed = run_jobs(scrapper, tmp_path)
+    # the pautas page, 3 year pages and 38 pautas
+    assert jobs.counts() == {"done": 42}
+    assert (len(latencies), failed) == (38, 0)
+    assert mock.wrong_year == []
+    served = detail_years(mock)
+    assert sorted(served, reverse=True) == served
+    for year in years:
+        assert sorted(os.listdir(tmp_path / "pautas" / year)) == pautas[year]
+
+
+def test_run_jobs_session_expires(scrapper, mock, tmp_path, expire_once):
+    expire_once(scrapper, "fetch_pauta")
+    jobs, latencies, failed = run_jobs(scrapper, tmp_path)
+    assert jobs.counts() == {"done": 42}
+    assert len(latencies) == 38
+    assert failed > 0
+    assert mock.wrong_year == []
+    assert logins(mock) == 2
+    for year in years:
+        assert sorted(os.listdir(tmp_path / "pautas" / year)) == pautas[year]
+
+
+def test_pipeline_fetches_a_year_at_a_time(scrapper, mock, tmp_path):
+    assert pipeline.run(str(tmp_path / "grades.db"), workers=4) == (878, 30, 20930)
+    assert mock.wrong_year == []
+    served = detail_years(mock)
+    assert sorted(served, reverse=True) == served
+    assert len(served) == 38
+
+
+def test_pipeline_session_expires(scrapper, mock, tmp_path, expire_once, capsys):
+    expire_once(pipeline, "stream_pauta")
+    assert pipeline.run(str(tmp_path / "grades.db"), workers=4) == (878, 30, 20930)
+    assert mock.wrong_year == []
+    assert logins(mock) == 2
+    assert "0 failed" in capsys.readouterr().out
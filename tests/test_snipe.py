@@ -0,0 +1,90 @@
+import threading
+import time
+
+from conftest import prepare_shot
+
+fast = dict(minimum=0.01, maximum=0.05)
+
+
+def outcomes(attempts):
+    return [(a.turma, a.outcome) for a in attempts]
+
+
+def test_full_turma_is_not_registered(infor_bot, mock):
+    mock.seats["PL3"] = 0
+    shot, session = prepare_shot(infor_bot, mock, ["PL3"])
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), max_attempts=3)
+    assert outcomes(attempts) == [("PL3", "not-open")] * 3
+    assert mock.registered == {}
+
+
+def test_open_turma_is_registered(infor_bot, mock):
+    shot, session = prepare_shot(infor_bot, mock, ["PL3"])
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), max_attempts=3)
+    assert outcomes(attempts) == [("PL3", "registered")]
+    assert list(mock.registered.values()) == ["PL3"]
+
+
+def test_waits_for_the_opening(infor_bot, mock):
+    shot, session = prepare_shot(infor_bot, mock, ["PL3"])
+    mock.open_at = mock.now() + 0.5
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), max_attempts=100)
+    assert attempts[0].outcome == "not-yet"
+    assert outcomes(attempts[-1:]) == [("PL3", "registered")]
+    assert list(mock.registered.values()) == ["PL3"]
+
+
+def test_fallback_is_held_until_the_hold_ends(infor_bot, mock):
+    # the enrolments close in 10 hours, the hold ends first
+    mock.open_at = mock.now() - 60
+    mock.seats["PL1"] = 0
+    shot, session = prepare_shot(infor_bot, mock, ["PL1", "PL2"])
+    start = time.time()
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), hold=1)
+    assert outcomes(attempts) == [("PL2", "registered")]
+    assert list(mock.registered.values()) == ["PL2"]
+    assert 1 <= time.time() - start < 5
+
+
+def test_fallback_switches_to_the_preferred_turma(infor_bot, mock):
+    mock.open_at = mock.now() - 60
+    mock.seats["PL1"] = 0
+    shot, session = prepare_shot(infor_bot, mock, ["PL1", "PL2"])
+    threading.Timer(0.5, mock.seats.__setitem__, ("PL1", 1)).start()
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), hold=10)
+    assert outcomes(attempts) == [("PL2", "registered"), ("PL1", "registered")]
+    assert list(mock.registered.values()) == ["PL1"]
+
+
+def test_fallback_is_not_held_after_the_enrolments_close(infor_bot, mock):
+    # open_at 0: the listing says they closed 10 hours after the epoch
+    mock.seats["PL1"] = 0
+    shot, session = prepare_shot(infor_bot, mock, ["PL1", "PL2"])
+    start = time.time()
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), hold=60)
+    assert outcomes(attempts) == [("PL2", "registered")]
+    assert time.time() - start < 5
+
+
+def test_expired_session_logs_in_again(infor_bot, mock):
+    shot, session = prepare_shot(infor_bot, mock, ["PL3"])
+    assert infor_bot.arm(shot, session)
+    manager = infor_bot.SessionManager(session)
+    mock.sessions.clear()
+    attempts = infor_bot.snipe(shot, session, infor_bot.Backoff(**fast), max_attempts=5,
+                               armed=True, manager=manager)
+    assert attempts[0].outcome == "error"
+    assert outcomes(attempts[-1:]) == [("PL3", "registered")]
+    assert manager.generation == 1
+    assert list(mock.registered.values()) == ["PL3"]
+
+
+def test_session_manager_survives_an_unreachable_server(infor_bot, mock):
+    session = infor_bot.new_session()
+    manager = infor_bot.SessionManager(session)
+    infor_bot.set_base_url("http://127.0.0.1:1")
+    try:
+        assert manager.ensure() is session
+    finally:
+        infor_bot.set_base_url(mock.url)
+    assert manager.stats()["failed_logins"] == 1